@@ -0,0 +1,301 @@
+import asyncio
+import os
+import random
+import sys
+import time
+
+import httpx
+import ujson as json
+
+
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+
+# httpx only decodes zstd when the zstandard package is installed
+try:
+    import zstandard  # noqa: F401
+    accept_encoding = "zstd, gzip"
+except ImportError:
+    accept_encoding = "gzip"
+
+# (method name, HTTP method, URI template), the same methods as Tweety
+endpoints = [
+    ("get_keywords", "GET", "/keywords"),
+    ("get_keyword", "GET", "/keywords/{}"),
+    ("get_keyword_id", "GET", "/keywords/{}/ids"),
+    ("get_keyword_media", "GET", "/keywords/{}/media"),
+    ("get_keyword_urls", "GET", "/keywords/{}/urls"),
+    ("get_keyword_texts", "GET", "/keywords/{}/texts"),
+    ("get_keyword_users", "GET", "/keywords/{}/users"),
+    ("get_keyword_user_count", "GET", "/keywords/{}/users/count"),
+    ("get_keyword_wordcloud", "GET", "/keywords/{}/wordcloud"),
+    ("get_keyword_series", "GET", "/keywords/{}/series"),
+    ("get_series", "GET", "/series"),
+    ("get_wordclouds", "GET", "/wordclouds"),
+    ("get_groups", "GET", "/groups"),
+    ("post_groups", "POST", "/groups"),
+    ("get_group", "GET", "/groups/{}"),
+    ("put_group", "PUT", "/groups/{}"),
+    ("delete_group", "DELETE", "/groups/{}"),
+    ("get_tweet", "GET", "/tweet/{}"),
+    ("delete_tweet", "DELETE", "/tweet/{}"),
+    ("patch_tweet", "PATCH", "/tweet/{}"),
+    ("get_tweets", "GET", "/tweets"),
+    ("patch_tweets", "PATCH", "/tweets"),
+    ("delete_tweets", "DELETE", "/tweets"),
+]
+
+# requests with these methods can be sent again without changing the outcome
+idempotent_methods = {"GET", "HEAD", "PUT", "DELETE"}
+retry_statuses = {502, 503, 504}
+
+
+class TweetyError(Exception):
+    """Base class of the errors raised by TweetyClient and AsyncTweety."""
+
+class TweetyConnectionError(TweetyError):
+    """The API could not be reached, or closed the connection."""
+
+class TweetyTimeout(TweetyError):
+    """The API did not respond within the timeout."""
+
+class TweetyHTTPError(TweetyError):
+    """The API responded with an error status."""
+
+    def __init__(self, status, message):
+        super().__init__("{}: {}".format(status, message))
+        self.status = status
+        self.message = message
+
+class TweetyBadRequest(TweetyHTTPError):
+    pass
+
+class TweetyForbidden(TweetyHTTPError):
+    pass
+
+class TweetyNotFound(TweetyHTTPError):
+    pass
+
+class TweetyServerError(TweetyHTTPError):
+    pass
+
+
+def http_error(response):
+    try:
+        j = response.json()
+        message = j.get("description") or j.get("title")
+    except ValueError:
+        message = response.text[:200]
+    return status_error(response.status_code, message)
+
+def status_error(status, message):
+    if status == 400:
+        return TweetyBadRequest(status, message)
+    elif status in [401, 403]:
+        return TweetyForbidden(status, message)
+    elif status == 404:
+        return TweetyNotFound(status, message)
+    elif status >= 500:
+        return TweetyServerError(status, message)
+    return TweetyHTTPError(status, message)
+
+def transport_error(error):
+    message = str(error) or type(error).__name__
+    if isinstance(error, httpx.TimeoutException) and not isinstance(error, httpx.ConnectTimeout):
+        return TweetyTimeout(message)
+    return TweetyConnectionError(message)
+
+def decode(response):
+    """The response body as Python objects, the Arrow format as bytes."""
+    if response.status_code == 204 or not response.content:
+        return None
+    if response.headers.get("Content-Type", "").startswith(ARROW_STREAM):
+        return response.content
+    return json.loads(response.content)
+
+def encode_body(data):
+    """Request bodies can be given already encoded or as Python objects."""
+    if data is None or isinstance(data, (bytes, str)):
+        return data, {}
+    return json.dumps(data), {"Content-Type": "application/json"}
+
+
+class BaseTweety:
+    """The configuration shared by TweetyClient and AsyncTweety.
+
+    Every call of the `endpoints` takes the URI parameters as positional
+    arguments, the request body as `data` and the GET parameters as keyword
+    arguments. The `timeout` keyword argument overrides the read timeout of one
+    call, e.g. for a long keyword window. With `raw=True` the undecoded body is
+    returned.
+
+    Failed requests raise a TweetyError. Idempotent requests are retried
+    `retries` times with exponential backoff when the connection fails or the
+    API answers 502, 503 or 504. Read timeouts aren't retried, the API is then
+    already busy with the query.
+    """
+
+    def __init__(self, base_url, token, pool_size=10, timeout=60, connect_timeout=5, retries=3, backoff=0.5):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.retries = retries
+        self.backoff = backoff
+        # wait for a free connection instead of failing, so fan-outs larger than the pool queue
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout, pool=None)
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.headers = {"Accept-Encoding": accept_encoding}
+
+        for (name, method, uri_template) in endpoints:
+            setattr(self, name, self.wrap_api(method, uri_template, name))
+
+    def wrap_api(self, method, uri_template, name):
+        def call(*uri_params, **params):
+            return self.request(method, uri_template.format(*uri_params), **params)
+
+        call.__name__ = name
+        return call
+
+    def prepare(self, params, timeout):
+        params["token"] = self.token
+        if timeout is None:
+            return httpx.USE_CLIENT_DEFAULT
+        return httpx.Timeout(timeout, connect=self.timeout.connect, pool=None)
+
+    def should_retry(self, method, attempt, error):
+        if method not in idempotent_methods or attempt >= self.retries:
+            return False
+        if isinstance(error, TweetyHTTPError):
+            return error.status in retry_statuses
+        return isinstance(error, TweetyConnectionError)
+
+    def retry_delay(self, attempt, response):
+        """Exponential backoff with jitter, or the Retry-After of the response."""
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(int(retry_after), self.backoff * 2 ** self.retries)
+        return self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+
+
+class TweetyClient(BaseTweety):
+    """Tweety with pooled connections, timeouts, retries and decoded results.
+
+        tweety = TweetyClient("http://127.0.0.1:8888", TOKEN)
+        counts = tweety.get_keywords(group="bloemen")   # a list
+    """
+
+    def __init__(self, base_url, token, **kwargs):
+        super().__init__(base_url, token, **kwargs)
+        self.client = httpx.Client(headers=self.headers, timeout=self.timeout, limits=self.limits)
+
+    def request(self, method, path, data=None, timeout=None, raw=False, **params):
+        timeout = self.prepare(params, timeout)
+        content, headers = encode_body(data)
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = self.client.request(method, self.base_url + path, params=params, content=content,
+                                               headers=headers, timeout=timeout)
+                error = http_error(response) if response.status_code >= 400 else None
+            except httpx.TransportError as e:
+                error = transport_error(e)
+            if error is None:
+                return response.content if raw else decode(response)
+            if not self.should_retry(method, attempt, error):
+                raise error
+            time.sleep(self.retry_delay(attempt, response))
+            attempt += 1
+
+    def close(self):
+        self.client.close()
+
+
+class AsyncTweety(BaseTweety):
+    """TweetyClient for asyncio, the calls are coroutines. At most `pool_size`
+    requests run at the same time, the rest wait for a connection.
+
+        async with AsyncTweety("http://127.0.0.1:8888", TOKEN) as tweety:
+            wordclouds = await tweety.map_keywords("get_keyword_wordcloud", keywords, start=..., end=...)
+    """
+
+    def __init__(self, base_url, token, **kwargs):
+        super().__init__(base_url, token, **kwargs)
+        self.client = httpx.AsyncClient(headers=self.headers, timeout=self.timeout, limits=self.limits)
+
+    async def request(self, method, path, data=None, timeout=None, raw=False, **params):
+        timeout = self.prepare(params, timeout)
+        content, headers = encode_body(data)
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = await self.client.request(method, self.base_url + path, params=params, content=content,
+                                                     headers=headers, timeout=timeout)
+                error = http_error(response) if response.status_code >= 400 else None
+            except httpx.TransportError as e:
+                error = transport_error(e)
+            if error is None:
+                return response.content if raw else decode(response)
+            if not self.should_retry(method, attempt, error):
+                raise error
+            await asyncio.sleep(self.retry_delay(attempt, response))
+            attempt += 1
+
+    async def map_keywords(self, name, keywords, **params):
+        """Call the endpoint `name` for all keywords concurrently. Returns a dict
+        with the results per keyword, raises the first error."""
+        call = getattr(self, name)
+        results = await asyncio.gather(*[call(kw, **params) for kw in keywords])
+        return dict(zip(keywords, results))
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+
+def load_api():
+    """Import api_local.py from the database directory, where the API runs."""
+    import hortiradar.database
+    path = os.path.dirname(hortiradar.database.__file__)
+    if path not in sys.path:
+        sys.path.append(path)
+    import api_local
+    return api_local
+
+
+class LocalTweety(BaseTweety):
+    """TweetyClient for processes on the API server. It calls the resources of
+    api.py in this process on its MongoDB client, with the same access checks,
+    but without HTTP. The results go through JSON like over HTTP, so they are
+    the same as those of TweetyClient (e.g. the string keys of the /series
+    bins), and errors of the resources are raised as TweetyServerError. It
+    needs the dependencies of the API. `timeout` has no effect.
+
+        tweety = LocalTweety(TOKEN)
+        tweets = tweety.get_keyword("appel", start=..., end=...)
+    """
+
+    def __init__(self, token, **kwargs):
+        super().__init__("local", token, **kwargs)
+        self.api = load_api()
+
+    def request(self, method, path, data=None, timeout=None, raw=False, **params):
+        if data is not None and not isinstance(data, (bytes, str)):
+            data = json.dumps(data)
+        try:
+            result = self.api.call(self.token, method, path, params, data)
+        except self.api.falcon.HTTPError as e:
+            raise status_error(int(str(e.status).split()[0]), e.description or e.title)
+        except Exception as e:
+            # like the 500 response of the API, e.g. for a failed MongoDB query
+            raise TweetyServerError(500, str(e) or type(e).__name__) from e
+        if result is None:
+            return b"" if raw else None
+        if isinstance(result, bytes):
+            return result
+        body = json.dumps(result)
+        return body.encode("utf-8") if raw else json.loads(body)
@@ -9,4 +9,4 @@ tweet_time_format = "%a %b %d %H:%M:%S +0000 %Y"
 
 from .cluster import Cluster
 from .tweet import ExtendedTweet, Token
-from .stories import Stories
\ No newline at end of file
+from .stories import Stories, StoryList
\ No newline at end of file
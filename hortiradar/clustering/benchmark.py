@@ -0,0 +1,157 @@
+import argparse
+import pickle
+from collections import Counter
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import numpy as np
+from tweepy.api import API
+from tweepy.models import Status
+
+from hortiradar.clustering import Cluster, ExtendedTweet, Stories, StoryList
+from hortiradar.clustering.util import cos_sim, get_token_array
+from hortiradar.database import stop_words
+from storify import is_spam, tweet_projection, tweetsdb
+
+
+class LegacyToken:
+    """Token as it was, before interning, for comparison."""
+
+    def __init__(self, tokenDict):
+        self.lemma = tokenDict["lemma"]
+        self.pos = tokenDict["pos"]
+        self.posprob = tokenDict["posprob"]
+
+    def __hash__(self):
+        return hash(self.lemma)
+
+    def __eq__(self, other):
+        return self.lemma == other.lemma
+
+    def filter_token(self):
+        pos_to_filter = ["BW", "LET", "LID", "VG", "TSW", "VZ", "VNW"]
+        if any(ptag in self.pos for ptag in pos_to_filter):
+            return True
+        return "http" in self.lemma.lower() or self.lemma.lower() in stop_words
+
+
+class TweepyExtendedTweet:
+    """ExtendedTweet as it was, with tweepy's Status, for comparison."""
+
+    def __init__(self, tweetDict):
+        self.tweet = Status.parse(API(), tweetDict["tweet"])
+        self.tokens = []
+        self.filt_tokens = []
+        for token in tweetDict["tokens"]:
+            t = LegacyToken(token)
+            self.tokens.append(t)
+            if not t.filter_token():
+                self.filt_tokens.append(t)
+
+
+def timed(f, *args):
+    t0 = perf_counter()
+    result = f(*args)
+    return result, perf_counter() - t0
+
+def load_tweets(n, hours):
+    end = datetime.utcnow()
+    query = {"num_keywords": {"$gt": 0}, "datetime": {"$gte": end - timedelta(hours=hours), "$lt": end}}
+    return [t for t in tweetsdb.find(query, projection=tweet_projection).limit(n) if not is_spam(t)]
+
+def bench_tweets(docs, args):
+    print("{} tweets".format(len(docs)))
+    for cls in [TweepyExtendedTweet, ExtendedTweet]:
+        tweets, parse_time = timed(lambda: [cls(d) for d in docs])
+        data, dump_time = timed(pickle.dumps, tweets)
+        _, load_time = timed(pickle.loads, data)
+        print("{:20} parse {:.3f}s, pickle {:.1f} MB, dumps {:.3f}s, loads {:.3f}s".format(
+            cls.__name__, parse_time, len(data) / 1e6, dump_time, load_time))
+
+
+def make_stories(tweets, n_stories):
+    """The tweets divided over n_stories stories."""
+    stories = StoryList()
+    for i in range(n_stories):
+        c = Cluster()
+        for tw in tweets[i::n_stories]:
+            c.add_tweet(tw)
+        if c.tweets:
+            stories.add(Stories(c))
+    return stories
+
+def attach_scan(stories, retweets):
+    """The retweet attachment of perform_clustering before the index."""
+    found = 0
+    for tw in retweets:
+        rt_id_str = tw.tweet.retweeted_status.id_str
+        for story in stories:
+            story_tweet_ids = [tw.tweet.id_str for tw in story.tweets]
+            if rt_id_str in story_tweet_ids:
+                found += 1
+                break
+    return found
+
+def attach_index(stories, retweets):
+    return sum(stories.find(tw.tweet.retweeted_status.id_str) is not None for tw in retweets)
+
+def bench_retweets(docs, args):
+    tweets = [ExtendedTweet(d) for d in docs]
+    originals = [tw for tw in tweets if not hasattr(tw.tweet, "retweeted_status")]
+    retweets = [tw for tw in tweets if hasattr(tw.tweet, "retweeted_status")]
+    stories = make_stories(originals, args.stories)
+    print("{} retweets, {} stories of {} tweets".format(len(retweets), len(stories), len(originals)))
+    for f in [attach_scan, attach_index]:
+        found, t = timed(f, stories, retweets)
+        print("{:14} {:.3f}s, {} attached".format(f.__name__, t, found))
+
+def best_tweet_loop(story):
+    """get_best_tweet before the batched similarities."""
+    story_array = get_token_array(story.tokens, story.filt_tokens)
+    ext_tweets = [tw for tw in story.tweets]
+    similarities = []
+    for tw in ext_tweets:
+        tweet_array = get_token_array(Counter(tw.tokens), story.filt_tokens)
+        sim_value = cos_sim(story_array, tweet_array)
+        if tw.tweet.id_str in story.retweets:
+            sim_value *= np.sqrt(len(story.retweets[tw.tweet.id_str]))
+        similarities.append(sim_value)
+    return ext_tweets[np.argmax(similarities)] if similarities else None
+
+def bench_best(docs, args):
+    tweets = [ExtendedTweet(d) for d in docs]
+    originals = [tw for tw in tweets if not hasattr(tw.tweet, "retweeted_status")]
+    stories = make_stories(originals, args.stories)
+    for tw in tweets:
+        if hasattr(tw.tweet, "retweeted_status"):
+            story = stories.find(tw.tweet.retweeted_status.id_str)
+            if story is not None:
+                story.add_tweet(tw)
+    print("{} stories of {} tweets".format(len(stories), len(originals)))
+    results = {}
+    for f in [best_tweet_loop, Stories.get_best_tweet]:
+        results[f.__name__], t = timed(lambda: [f(story) for story in stories])
+        print("{:16} {:.3f}s".format(f.__name__, t))
+    same = sum(a is b for (a, b) in zip(results["best_tweet_loop"], results["get_best_tweet"]))
+    print("same best tweet for {} of {} stories".format(same, len(stories)))
+
+
+benchmarks = {
+    "best": bench_best,
+    "retweets": bench_retweets,
+    "tweets": bench_tweets,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the clustering data structures on recent tweets.")
+    parser.add_argument("benchmark", choices=sorted(benchmarks))
+    parser.add_argument("-n", type=int, default=20000, help="number of tweets")
+    parser.add_argument("--hours", type=int, default=24, help="load the tweets of the last hours")
+    parser.add_argument("--stories", type=int, default=200, help="number of active stories")
+    args = parser.parse_args()
+    benchmarks[args.benchmark](load_tweets(args.n, args.hours), args)
+
+
+if __name__ == "__main__":
+    main()
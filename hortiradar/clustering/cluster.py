@@ -2,10 +2,8 @@ from calendar import timegm
 from collections import Counter
 from datetime import datetime, timedelta
 
-import numpy as np
-
 from hortiradar.clustering import tweet_time_format
-from .util import cos_sim, round_time, dt_to_ts, get_token_array
+from .util import best_tweet, round_time, dt_to_ts
 
 
 class Cluster:
@@ -39,21 +37,7 @@ class Cluster:
             self.tweets.update([ext_tweet])
 
     def get_best_tweet(self):
-        cluster_array = get_token_array(self.tokens, self.filt_tokens)
-        ext_tweets = [tweet for tweet in self.tweets]
-        similarities = []
-        for tw in ext_tweets:
-            tweet_tokens = Counter(tw.tokens)
-            tweet_array = get_token_array(tweet_tokens, self.filt_tokens)
-            sim_value = cos_sim(cluster_array, tweet_array)
-            if tw.tweet.id_str in self.retweets:
-                sim_value *= np.sqrt(len(self.retweets[tw.tweet.id_str]))
-            similarities.append(sim_value)
-
-        if similarities:
-            return ext_tweets[np.argmax(similarities)]
-        else:
-            return None
+        return best_tweet(self.tokens, self.filt_tokens, self.tweets, self.retweets)
 
     def get_timeseries(self):
         tsdict = Counter()
@@ -0,0 +1,58 @@
+import argparse
+from collections import defaultdict
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from scipy.sparse import csgraph
+
+from hortiradar import time_format
+from hortiradar.clustering.similarity import lsh_similarity_graph, similarity_graph, tf_matrix
+from hortiradar.clustering.util import round_time
+from storify import get_filt_tokens, get_tweets, lsh_bands, lsh_rows, tweet_threshold
+
+
+def clusters(graph):
+    _, labels = csgraph.connected_components(graph, directed=False)
+    members = defaultdict(set)
+    for (i, label) in enumerate(labels):
+        members[label].add(i)
+    return {frozenset(m) for m in members.values()}
+
+def timed(f, *args):
+    t0 = perf_counter()
+    result = f(*args)
+    return result, perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the LSH clustering of storify with the exact all pairs clustering.")
+    parser.add_argument("key", help="group or keyword")
+    parser.add_argument("--type", "-t", choices=["groups", "keywords"], default="groups")
+    parser.add_argument("--start", help="the hour to cluster, format: %s (default: the last hour)" % time_format.replace("%", "%%"))
+    parser.add_argument("--bands", type=int, default=lsh_bands)
+    parser.add_argument("--rows", type=int, default=lsh_rows)
+    args = parser.parse_args()
+
+    start = round_time(datetime.strptime(args.start, time_format)) if args.start else round_time(datetime.utcnow()) - timedelta(hours=1)
+    tweets = [tw for tw in get_tweets(start, start + timedelta(hours=1), args.key, args.type)
+              if not hasattr(tw.tweet, "retweeted_status")]
+    X = tf_matrix([get_filt_tokens(tw) for tw in tweets])
+
+    exact, exact_time = timed(similarity_graph, X, tweet_threshold)
+    lsh, lsh_time = timed(lsh_similarity_graph, X, tweet_threshold, args.bands, args.rows)
+    # the diagonal is in both graphs
+    exact_edges = (exact.nnz - int(exact.diagonal().astype(bool).sum())) // 2
+    lsh_edges = (lsh.nnz - int(lsh.diagonal().sum())) // 2
+    exact_clusters, lsh_clusters = clusters(exact), clusters(lsh)
+    same = exact_clusters & lsh_clusters
+
+    print("{} non-retweets, bands={} rows={}".format(len(tweets), args.bands, args.rows))
+    print("exact: {:.2f}s, {} similar pairs, {} clusters".format(exact_time, exact_edges, len(exact_clusters)))
+    print("lsh:   {:.2f}s, {} similar pairs, {} clusters".format(lsh_time, lsh_edges, len(lsh_clusters)))
+    print("pair recall: {:.3f}".format(lsh_edges / exact_edges if exact_edges else 1))
+    print("identical clusters: {} ({:.3f} of the tweets)".format(
+        len(same), sum(len(c) for c in same) / len(tweets) if tweets else 1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import numpy as np
+from scipy import sparse
+
+
+def tf_matrix(texts):
+    """Sparse (texts x vocabulary) matrix of term counts with unit length rows,
+    like the gensim bag-of-words vectors. Empty texts are zero rows."""
+    vocabulary = {}
+    indptr = [0]
+    indices = []
+    for text in texts:
+        for token in text:
+            indices.append(vocabulary.setdefault(token, len(vocabulary)))
+        indptr.append(len(indices))
+    data = np.ones(len(indices), dtype=np.float32)
+    # duplicate entries are summed into the counts
+    X = sparse.csr_matrix((data, indices, indptr), shape=(len(texts), max(len(vocabulary), 1)))
+    X.sum_duplicates()
+    norms = np.sqrt(X.multiply(X).sum(axis=1)).A1
+    norms[norms == 0] = 1
+    return sparse.diags((1 / norms).astype(np.float32)).dot(X).tocsr()
+
+def similarity_graph(X, threshold, block_size=1000):
+    """The pairs of rows of X with a cosine similarity above the threshold, as a
+    sparse 0/1 adjacency matrix. Computed in blocks of rows, so only one
+    block of similarities is in memory at a time."""
+    n = X.shape[0]
+    XT = X.T.tocsc()
+    blocks = []
+    for i in range(0, n, block_size):
+        S = X[i:i + block_size].dot(XT).tocsr()
+        S.data = S.data > threshold
+        S.eliminate_zeros()
+        blocks.append(S)
+    if not blocks:
+        return sparse.csr_matrix((0, 0), dtype=np.float32)
+    return sparse.vstack(blocks, format="csr")
+
+def minhash_signatures(X, num_hashes, seed=0, chunk_size=1000):
+    """MinHash signatures of the token sets of the rows of X, one row per text.
+    Empty texts get the maximum hash value everywhere."""
+    prime = (1 << 31) - 1
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, prime, num_hashes).astype(np.int64)
+    b = rng.randint(0, prime, num_hashes).astype(np.int64)
+    signatures = np.full((X.shape[0], num_hashes), prime, dtype=np.int64)
+    for i in range(0, X.shape[0], chunk_size):
+        chunk = X[i:i + chunk_size]
+        nonempty = np.flatnonzero(np.diff(chunk.indptr))
+        if not len(nonempty):
+            continue
+        hashes = (np.outer(chunk.indices, a) + b) % prime
+        signatures[i + nonempty] = np.minimum.reduceat(hashes, chunk.indptr[nonempty], axis=0)
+    return signatures
+
+def candidate_pairs(signatures, bands, rows, max_bucket=100):
+    """The pairs (i, j) with i < j of which the signatures are equal in at least
+    one band, as two arrays. Buckets of more than max_bucket texts, like
+    copy-paste spam, are chained instead of paired all-to-all: every member is
+    paired with the next, which keeps them in one component with a linear
+    number of pairs."""
+    n = signatures.shape[0]
+    pairs = np.array([], dtype=np.int64)
+    for band in range(bands):
+        sig = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        _, buckets = np.unique(sig.view(np.dtype((np.void, sig.dtype.itemsize * rows))), return_inverse=True)
+        order = np.argsort(buckets.ravel(), kind="stable")
+        sorted_buckets = buckets.ravel()[order]
+        starts = np.flatnonzero(np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]])
+        ends = np.r_[starts[1:], n]
+        shared = ends - starts > 1
+        band_pairs = []
+        for (s, e) in zip(starts[shared], ends[shared]):
+            members = np.sort(order[s:e])
+            if len(members) > max_bucket:
+                band_pairs.append(members[:-1] * n + members[1:])
+            else:
+                i, j = np.triu_indices(len(members), 1)
+                band_pairs.append(members[i] * n + members[j])
+        # the bands mostly find the same pairs, deduplicate as we go
+        if band_pairs:
+            pairs = np.union1d(pairs, np.concatenate(band_pairs))
+    return pairs // n, pairs % n
+
+def lsh_similarity_graph(X, threshold, bands, rows, seed=0, chunk_size=100000, max_bucket=100):
+    """similarity_graph from the candidate pairs of MinHash LSH over the token
+    sets, verified with the exact cosine similarity. Pairs that aren't
+    candidates are missed: tweets with Jaccard similarity J are candidates with
+    probability 1 - (1 - J^rows)^bands. Large buckets are chained, see
+    candidate_pairs, so they only stay connected through similar neighbours."""
+    n = X.shape[0]
+    nonempty = np.flatnonzero(np.diff(X.indptr))
+    signatures = minhash_signatures(X[nonempty], bands * rows, seed)
+    i, j = candidate_pairs(signatures, bands, rows, max_bucket)
+    i, j = nonempty[i], nonempty[j]
+    keep = np.zeros(len(i), dtype=bool)
+    for s in range(0, len(i), chunk_size):
+        sims = X[i[s:s + chunk_size]].multiply(X[j[s:s + chunk_size]]).sum(axis=1).A1
+        keep[s:s + chunk_size] = sims > threshold
+    i, j = i[keep], j[keep]
+    # the diagonal like similarity_graph, every text with tokens is similar to itself
+    r = np.concatenate([i, j, nonempty])
+    c = np.concatenate([j, i, nonempty])
+    return sparse.csr_matrix((np.ones(len(r), dtype=bool), (r, c)), shape=(n, n))
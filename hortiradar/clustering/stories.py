@@ -4,9 +4,10 @@ import random
 
 import numpy as np
 from pattern.nl import sentiment
+from scipy import sparse
 
 from hortiradar.clustering import Config, tweet_time_format
-from .util import cos_sim, round_time, dt_to_ts, get_token_array
+from .util import best_tweet, cos_sim, decimals, round_time, dt_to_ts, get_token_array
 from hortiradar.database import obscene_words
 
 max_idle = Config.getint('storify:parameters', 'max_idle')
@@ -63,7 +64,8 @@ class Stories:
             return False
 
     def is_similar(self, c):
-        """Calculate if the cluster matches to the story"""
+        """Calculate if the cluster matches to the story. The similarities are
+        rounded to `decimals`, see story_similarities."""
         all_current = self.filt_tokens & c.filt_tokens
         story_array = get_token_array(self.tokens, all_current)
         cluster_array = get_token_array(c.tokens, all_current)
@@ -73,6 +75,7 @@ class Stories:
         cluster_array = get_token_array(c.tokens, all_current)
         original = cos_sim(story_array, cluster_array)
 
+        current, original = round(current, decimals), round(original, decimals)
         return current >= self.threshold and original >= self.original_threshold, current
 
     def add_cluster(self, c):
@@ -147,21 +150,7 @@ class Stories:
         return filt_tweets
 
     def get_best_tweet(self):
-        story_array = get_token_array(self.tokens, self.filt_tokens)
-        ext_tweets = [tw for tw in self.tweets]
-        similarities = []
-        for tw in ext_tweets:
-            tweet_tokens = Counter(tw.tokens)
-            tweet_array = get_token_array(tweet_tokens, self.filt_tokens)
-            sim_value = cos_sim(story_array, tweet_array)
-            if tw.tweet.id_str in self.retweets:
-                sim_value *= np.sqrt(len(self.retweets[tw.tweet.id_str]))
-            similarities.append(sim_value)
-
-        if similarities:
-            return ext_tweets[np.argmax(similarities)]
-        else:
-            return None
+        return best_tweet(self.tokens, self.filt_tokens, self.tweets, self.retweets)
 
     def get_wordcloud(self):
         wordcloud = []
@@ -479,3 +468,85 @@ class Stories:
         jDict["interaction_tweets"] = interaction_tweets
 
         return jDict
+
+
+def sparse_rows(rows, n_cols):
+    """CSR matrix from a list of {column: value} dicts."""
+    indptr = np.cumsum([0] + [len(r) for r in rows])
+    indices = [i for r in rows for i in r]
+    data = [v for r in rows for v in r.values()]
+    return sparse.csr_matrix((np.array(data, dtype=np.float64), np.array(indices, dtype=np.int64), indptr),
+                             shape=(len(rows), n_cols))
+
+def cluster_vectors(clusters):
+    """The filtered token counts of the clusters over the vocabulary of their
+    filtered lemmas, as transposed (counts, squared counts, indicator) matrices.
+    Lemmas outside this vocabulary can't be in the token intersection of
+    Stories.is_similar."""
+    vocabulary = {}
+    counts = []
+    for c in clusters:
+        counts.append({vocabulary.setdefault(t.lemma, len(vocabulary)): c.tokens[t] for t in c.filt_tokens})
+    B = sparse_rows(counts, len(vocabulary))
+    return vocabulary, (B.T.tocsc(), B.multiply(B).T.tocsc(), (B > 0).astype(np.float64).T.tocsc())
+
+def cosine(num, d1, d2):
+    norms = np.sqrt(d1 * d2)
+    return np.divide(num, norms, out=np.zeros_like(num), where=norms > 0)
+
+def story_similarities(stories, vocabulary, cluster_matrices):
+    """The (current, original) similarities of Stories.is_similar for all pairs
+    of the stories and the clusters of cluster_vectors, as dense matrices.
+
+    Both are cosine similarities restricted to the filtered tokens the story and
+    the cluster share. With the masked count rows A (story) and B (cluster) and
+    the indicators F of their filtered tokens that is A.B over the square roots
+    of A^2.F_c and F_s.B^2, all sparse matrix products. They are rounded to
+    `decimals` like in is_similar, so both give the same similarities although
+    they sum in a different order."""
+    BT, B2T, FT = cluster_matrices
+    current, original, filt = [], [], []
+    for story in stories:
+        cols = [(vocabulary[t.lemma], t) for t in story.filt_tokens if t.lemma in vocabulary]
+        current.append({i: story.tokens[t] for (i, t) in cols})
+        original.append({i: story.original_tokens[t] for (i, t) in cols})
+        filt.append({i: 1 for (i, _) in cols})
+    A, O, F = (sparse_rows(rows, len(vocabulary)) for rows in [current, original, filt])
+    d2 = (F @ B2T).toarray()
+    return (np.round(cosine((A @ BT).toarray(), (A.multiply(A) @ FT).toarray(), d2), decimals),
+            np.round(cosine((O @ BT).toarray(), (O.multiply(O) @ FT).toarray(), d2), decimals))
+
+
+class StoryList(list):
+    """The active stories of a key with an index of the story of every tweet by
+    id_str, so retweets are attached to their story in O(1). The index is
+    pickled with the stories and kept up to date by add, add_cluster and drop.
+    """
+
+    def __init__(self, stories=()):
+        super().__init__()
+        self.index = {}
+        for story in stories:
+            self.add(story)
+
+    def index_tweets(self, story, tweets):
+        for tw in tweets:
+            self.index.setdefault(tw.tweet.id_str, story)
+
+    def add(self, story):
+        self.append(story)
+        self.index_tweets(story, story.tweets)
+
+    def add_cluster(self, story, c):
+        story.add_cluster(c)
+        self.index_tweets(story, c.tweets)
+
+    def drop(self, story):
+        # by identity, stories created in the same run can have the same id
+        del self[next(i for (i, s) in enumerate(self) if s is story)]
+        for tw in story.tweets:
+            if self.index.get(tw.tweet.id_str) is story:
+                del self.index[tw.tweet.id_str]
+
+    def find(self, id_str):
+        return self.index.get(id_str)
@@ -1,22 +1,28 @@
+from collections import defaultdict
 from datetime import datetime, timedelta
 from getopt import getopt, GetoptError
+import multiprocessing
 import pickle
 import sys
+import traceback
 
-import gensim
 import numpy as np
 from redis import StrictRedis
 from scipy.sparse import csgraph
 
-from hortiradar.clustering import Config, ExtendedTweet, Cluster, Stories
+from hortiradar.clustering import Config, ExtendedTweet, Cluster, Stories, StoryList
+from hortiradar.clustering.similarity import lsh_similarity_graph, similarity_graph, tf_matrix
+from hortiradar.clustering.stories import cluster_vectors, story_similarities
 from hortiradar.clustering.util import round_time
 from hortiradar.database import get_db, get_keywords
+import hortiradar.database.keywords
 
 
 db = get_db()
 groups = [g["name"] for g in db.groups.find({}, projection={"name": True, "_id": False})]
 storiesdb = db.stories
 tweetsdb = db.tweets
+snapshot = None     # the HourSnapshot of the current run
 
 keywords = get_keywords(local=True)
 
@@ -24,24 +30,31 @@ redis = StrictRedis()
 
 spam_level = Config.getfloat('database:parameters', "spam_level")
 tweet_threshold = Config.getfloat('storify:parameters', 'tweet_threshold')
+lsh_min_tweets = Config.getint('storify:lsh', 'min_tweets')
+lsh_bands = Config.getint('storify:lsh', 'bands')
+lsh_rows = Config.getint('storify:lsh', 'rows')
+workers = Config.getint('storify:pool', 'workers')
+max_tasks_per_child = Config.getint('storify:pool', 'max_tasks_per_child')
 
 def is_spam(t):
     return t.get("spam") is not None and t["spam"] > spam_level
 
 def get_filt_tokens(tweet):
-    return [t.lemma for t in tweet.tokens if not t.filter_token()]
+    return [t.lemma for t in tweet.filt_tokens]
+
+tweet_projection = {
+    "tweet.id_str": True, "tokens": True, "tweet.entities": True, "tweet.created_at": True,
+    "tweet.user.id_str": True, "tweet.user.screen_name": True, "tweet.retweeted_status.user.id_str": True,
+    "tweet.retweeted_status.user.screen_name": True, "tweet.retweeted_status.id_str": True,
+    "tweet.in_reply_to_user_id_str": True, "tweet.in_reply_to_screen_name": True,
+    "tweet.text": True, "spam": True, "_id": False
+}
 
 def get_tweets(start, end, key, keytype):
     jsontweets = tweetsdb.find({
         keytype: key,
         "datetime": {"$gte": start, "$lt": end}
-    }, projection={
-        "tweet.id_str": True, "tokens": True, "tweet.entities": True, "tweet.created_at": True,
-        "tweet.user.id_str": True, "tweet.user.screen_name": True, "tweet.retweeted_status.user.id_str": True,
-        "tweet.retweeted_status.user.screen_name": True, "tweet.retweeted_status.id_str": True,
-        "tweet.in_reply_to_user_id_str": True, "tweet.in_reply_to_screen_name": True,
-        "tweet.text": True, "spam": True, "_id": False
-    })
+    }, projection=tweet_projection)
 
     tweets = []
     for jtweet in jsontweets:
@@ -50,38 +63,88 @@ def get_tweets(start, end, key, keytype):
 
     return tweets
 
-def perform_clustering(tweets, stories, key):
+
+class HourSnapshot:
+    """The tweets of an hour for all keys: fetched with one query, every tweet
+    parsed once and shared by its groups and keywords.
+
+    If the hour has at most `lsh_min_tweets` non-retweets, their exact
+    similarity graph is computed once as well. Tweet similarity doesn't depend
+    on the key, so the graph of a key is the subgraph induced by its tweets.
+    Otherwise keys with at most `lsh_min_tweets` non-retweets are computed
+    exactly on their rows of the shared vectors. Larger keys use LSH on their
+    own tweets, like without a snapshot: the LSH candidates depend on the other
+    tweets in the buckets, so a subgraph of an LSH graph of the hour differs.
+    """
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.tweets = {"groups": defaultdict(list), "keywords": defaultdict(list)}
+        non_retweets = []
+        jsontweets = tweetsdb.find({
+            "num_keywords": {"$gt": 0},
+            "datetime": {"$gte": start, "$lt": end}
+        }, projection=dict(tweet_projection, groups=True, keywords=True))
+
+        for jtweet in jsontweets:
+            if is_spam(jtweet):
+                continue
+            tw = ExtendedTweet(jtweet)
+            for group in jtweet.get("groups", []):
+                self.tweets["groups"][group].append(tw)
+            for keyword in jtweet.get("keywords", []):
+                self.tweets["keywords"][keyword].append(tw)
+            if not hasattr(tw.tweet, "retweeted_status"):
+                non_retweets.append(tw)
+
+        self.index = {tw.tweet.id_str: i for (i, tw) in enumerate(non_retweets)}
+        self.X = tf_matrix([get_filt_tokens(tw) for tw in non_retweets])
+        self.exact = len(non_retweets) <= lsh_min_tweets
+        self.graph = similarity_graph(self.X, tweet_threshold) if self.exact else None
+
+    def get_tweets(self, key, keytype):
+        return self.tweets[keytype].get(key, [])
+
+    def get_graph(self, tweets):
+        """The similarity graph of the non-retweets, in their order."""
+        if len(tweets) > lsh_min_tweets:
+            return tweet_graph(tweets)
+        rows = [self.index[tw.tweet.id_str] for tw in tweets]
+        if self.exact:
+            return self.graph[rows][:, rows]
+        return similarity_graph(self.X[rows], tweet_threshold)
+
+
+def tweet_graph(tweets):
+    """The similarity graph of the tweets, with LSH for more than `lsh_min_tweets`."""
+    X = tf_matrix([get_filt_tokens(tw) for tw in tweets])
+    if len(tweets) > lsh_min_tweets:
+        return lsh_similarity_graph(X, tweet_threshold, lsh_bands, lsh_rows)
+    return similarity_graph(X, tweet_threshold)
+
+
+def perform_clustering(tweets, stories, key, snapshot=None):
     non_retweets = []
     for tw in tweets:
         if hasattr(tw.tweet, "retweeted_status"):
-            rt_id_str = tw.tweet.retweeted_status.id_str
-            for story in stories:
-                story_tweet_ids = [tw.tweet.id_str for tw in story.tweets]
-                if rt_id_str in story_tweet_ids:
-                    story.add_tweet(tw)
-                    break
+            story = stories.find(tw.tweet.retweeted_status.id_str)
+            if story is not None:
+                story.add_tweet(tw)
         else:
             non_retweets.append(tw)
 
     if non_retweets:
-        clusters = perform_clustering_tweets(non_retweets, key)
+        clusters = perform_clustering_tweets(non_retweets, key, snapshot)
     else:
         clusters = []
 
     return clusters, stories
 
-def perform_clustering_tweets(tweets, key):
-    texts = [get_filt_tokens(tw) for tw in tweets]
-    dictionaries = gensim.corpora.Dictionary(texts)
-    corpus = [dictionaries.doc2bow(text) for text in texts]
-    sims = gensim.similarities.Similarity('/tmp/clustering_{g}'.format(g=key), corpus, num_features=len(dictionaries))
+def perform_clustering_tweets(tweets, key, snapshot=None):
+    graph = snapshot.get_graph(tweets) if snapshot else tweet_graph(tweets)
 
-    mat = []
-    for j, tw in enumerate(tweets):
-        mat.append([1 if x > tweet_threshold else 0 for x in sims[dictionaries.doc2bow(get_filt_tokens(tw))]])
-    mat = np.array(mat)
-
-    n_clusters, cluster_labels = csgraph.connected_components(mat, directed=False)
+    n_clusters, cluster_labels = csgraph.connected_components(graph, directed=False)
     clusters = [Cluster() for _ in range(n_clusters)]
 
     for num, label in enumerate(cluster_labels):
@@ -92,12 +155,22 @@ def perform_clustering_tweets(tweets, key):
 def storify_clusters(stories, clusters):
     if not stories:
         for c in clusters:
-            stories.append(Stories(c))
+            stories.add(Stories(c))
     else:
         matched_boolean = [False] * len(stories)
 
-        for c in clusters:
-            sim, vals = zip(*[s.is_similar(c) for s in stories])
+        # the similarities of every story (also the ones added here) to every cluster
+        vocabulary, cluster_matrices = cluster_vectors(clusters)
+        n = len(stories)
+        current = np.zeros((n + len(clusters), len(clusters)))
+        original = np.zeros_like(current)
+        current[:n], original[:n] = story_similarities(stories, vocabulary, cluster_matrices)
+        thresholds = np.array([[s.threshold, s.original_threshold] for s in stories] +
+                              [[0, 0]] * len(clusters))
+
+        for k, c in enumerate(clusters):
+            vals = current[:n, k]
+            sim = (vals >= thresholds[:n, 0]) & (original[:n, k] >= thresholds[:n, 1])
             match = False
             for m in np.flipud(np.argsort(vals)):
                 if sim[m]:
@@ -105,11 +178,16 @@ def storify_clusters(stories, clusters):
                     break
 
             if match and not matched_boolean[m]:
-                stories[m].add_cluster(c)
+                stories.add_cluster(stories[m], c)
                 matched_boolean[m] = True
             else:
-                stories.append(Stories(c))
+                stories.add(Stories(c))
                 matched_boolean.append(True)
+                m = n
+                n += 1
+                thresholds[m] = [stories[m].threshold, stories[m].original_threshold]
+            # story m changed or is new: its similarities to the next clusters
+            current[m:m + 1], original[m:m + 1] = story_similarities([stories[m]], vocabulary, cluster_matrices)
 
         for j, story in enumerate(stories):
             if not matched_boolean[j]:
@@ -120,16 +198,16 @@ def storify_clusters(stories, clusters):
     return stories
 
 def find_finished_stories(stories):
-    active_stories = []
     finished_stories = []
     for story in stories:
         if story.close_story():
             story.end_story()
             finished_stories.append(story)
-        else:
-            active_stories.append(story)
 
-    return active_stories, finished_stories
+    for story in finished_stories:
+        stories.drop(story)
+
+    return stories, finished_stories
 
 def output_stories(stories, key, keytype):
     for story in stories:
@@ -140,13 +218,16 @@ def output_stories(stories, key, keytype):
 
         storiesdb.insert_one(storydict)
 
-def run_storify(stories, key, keytype):
-    end = round_time(datetime.utcnow())
-    start = end - timedelta(hours=1)
-    tweets = get_tweets(start, end, key, keytype)
+def run_storify(stories, key, keytype, snapshot=None):
+    if snapshot:
+        tweets = snapshot.get_tweets(key, keytype)
+    else:
+        end = round_time(datetime.utcnow())
+        start = end - timedelta(hours=1)
+        tweets = get_tweets(start, end, key, keytype)
 
     if tweets:
-        clusters, stories = perform_clustering(tweets, stories, key)
+        clusters, stories = perform_clustering(tweets, stories, key, snapshot)
 
         stories = storify_clusters(stories, clusters)
         stories, finished_stories = find_finished_stories(stories)
@@ -156,38 +237,87 @@ def run_storify(stories, key, keytype):
 
     return stories
 
-def process_key(key, keytype):
+def process_key(key, keytype, snapshot=None):
     k = "s:{k}".format(k=key)
-    v = redis.get(k)
-    if v:
-        stories = pickle.loads(v)
-    else:
-        stories = []
-
-    stories = run_storify(stories, key, keytype)
-
-    stories_out = pickle.dumps(stories)
-    redis.set(k, stories_out, ex=60 * 90)
+    # a run that is still busy with the key (e.g. of the previous hour) goes first
+    with redis.lock("lock:" + k, timeout=60 * 60):
+        v = redis.get(k)
+        if v:
+            stories = pickle.loads(v)
+            if not isinstance(stories, StoryList):     # pickled before the index
+                stories = StoryList(stories)
+        else:
+            stories = StoryList()
+
+        stories = run_storify(stories, key, keytype, snapshot)
+
+        stories_out = pickle.dumps(stories)
+        redis.set(k, stories_out, ex=60 * 90)
+
+def init_worker(shared_snapshot):
+    """MongoDB clients aren't fork safe, every worker process connects with its
+    own. The pool forks, so the snapshot is inherited from the parent process,
+    not copied."""
+    global storiesdb, tweetsdb, snapshot
+    # get_db caches the client of the parent process
+    hortiradar.database.keywords.DATABASE = None
+    db = get_db()
+    storiesdb = db.stories
+    tweetsdb = db.tweets
+    snapshot = shared_snapshot
+
+def process_key_safe(args):
+    try:
+        process_key(*args, snapshot=snapshot)
+        return None
+    except Exception:
+        return "{}: {}".format(args[0], traceback.format_exc())
+
+def process_keys(keys, n_workers=workers):
+    """Storify the (key, keytype) pairs of the last hour with a pool of processes.
+    The tweets of the hour are loaded once for all keys. A worker handles one
+    key at a time and is replaced after `max_tasks_per_child` keys to return the
+    memory of large keys. Returns the errors of the failed keys."""
+    global snapshot
+    end = round_time(datetime.utcnow())
+    snapshot = HourSnapshot(end - timedelta(hours=1), end)
+    if n_workers <= 1:
+        return [e for e in map(process_key_safe, keys) if e]
+    context = multiprocessing.get_context("fork")
+    with context.Pool(n_workers, initializer=init_worker, initargs=(snapshot,), maxtasksperchild=max_tasks_per_child) as pool:
+        return [e for e in pool.imap_unordered(process_key_safe, keys) if e]
 
 def main(argv):
+    usage = "storify.py -t <groups|keywords|all> [-w <workers>]"
     try:
-        opts, args = getopt(argv, "ht:", ["type="])
+        opts, args = getopt(argv, "ht:w:", ["type=", "workers="])
     except GetoptError:
-        print("test.py -t <processing type>")
+        print(usage)
         sys.exit(2)
+    n_workers = workers
+    keytype = None
     for opt, arg in opts:
         if opt == "-h":
-            print("test.py -t <processing type>")
+            print(usage)
             sys.exit()
         elif opt in ["-t", "--type"]:
-            if arg == "groups":
-                for group in groups:
-                    process_key(group, arg)
-            elif arg == "keywords":
-                for keyword in keywords:
-                    process_key(keyword, arg)
-            else:
-                raise(NotImplementedError)
+            keytype = arg
+        elif opt in ["-w", "--workers"]:
+            n_workers = int(arg)
+    if keytype == "groups":
+        keys = [(group, keytype) for group in groups]
+    elif keytype == "keywords":
+        keys = [(keyword, keytype) for keyword in keywords]
+    elif keytype == "all":
+        keys = [(group, "groups") for group in groups] + [(keyword, "keywords") for keyword in keywords]
+    else:
+        raise(NotImplementedError)
+
+    errors = process_keys(keys, n_workers)
+    for e in errors:
+        print(e)
+    if errors:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,57 @@
-from tweepy.api import API
-from tweepy.models import Status
+from datetime import datetime
+from email.utils import parsedate
+import sys
+import weakref
 
 from hortiradar.database import stop_words
 
 
+def restore_slots(obj, state):
+    """__setstate__ for slotted classes, also of pickles with a __dict__."""
+    if isinstance(state, tuple):
+        state = state[1]
+    for (k, v) in state.items():
+        setattr(obj, k, v)
+
+
+class User:
+    __slots__ = ("id_str", "screen_name")
+
+    def __init__(self, userDict):
+        self.id_str = userDict.get("id_str")
+        self.screen_name = userDict.get("screen_name")
+
+    __setstate__ = restore_slots
+
+
+class Tweet:
+    """The fields of a tweet that clustering and the story output use, with the
+    attribute names of tweepy's Status. Like there, fields missing in the
+    document are missing attributes (check with hasattr)."""
+
+    __slots__ = ("id_str", "created_at", "text", "entities", "user", "retweeted_status", "retweet_count",
+                 "in_reply_to_user_id_str", "in_reply_to_screen_name", "coordinates")
+
+    def __init__(self, tweetDict):
+        for (k, v) in tweetDict.items():
+            if k == "user":
+                v = User(v)
+            elif k == "retweeted_status":
+                v = Tweet(v)
+            elif k == "created_at":
+                v = datetime(*parsedate(v)[:6])     # as tweepy parses it
+            elif k not in self.__slots__:
+                continue
+            setattr(self, k, v)
+
+    __setstate__ = restore_slots
+
+
 class ExtendedTweet:
+    __slots__ = ("tweet", "keywords", "groups", "tokens", "filt_tokens")
 
     def __init__(self, tweetDict):
-        self.tweet = Status.parse(API(), tweetDict["tweet"])
+        self.tweet = Tweet(tweetDict["tweet"])
         try:
             self.keywords = tweetDict["keywords"]
         except KeyError:
@@ -19,9 +63,9 @@ class ExtendedTweet:
         self.tokens = []
         self.filt_tokens = []
         for token in tweetDict["tokens"]:
-            t = Token(token)
+            t = Token.get(token["lemma"], token["pos"])
             self.tokens.append(t)
-            if not t.filter_token():
+            if not t.filtered:
                 self.filt_tokens.append(t)
 
     def __hash__(self):
@@ -33,30 +77,61 @@ class ExtendedTweet:
         else:
             return False
 
+    # stories pickled in Redis before the slots still load
+    __setstate__ = restore_slots
+
+
+pos_to_filter = ("BW", "LET", "LID", "VG", "TSW", "VZ", "VNW")
+
+
+def is_filtered(lemma, pos):
+    if any(ptag in pos for ptag in pos_to_filter):
+        return True
+    lower = lemma.lower()
+    return "http" in lower or lower in stop_words
+
 
 class Token:
+    """A lemma with its part of speech tag. Tokens are interned: get them with
+    Token.get(lemma, pos), which returns the one shared object of that pair.
+    Whether the token is filtered from clustering is computed once.
+
+    Tokens compare equal on their lemma, so Counters of tokens count lemmas.
+    Mostly they are the same object and that is checked first. The table only
+    holds tokens that are in use, so long running workers don't keep every
+    token they have seen.
+    """
+
+    __slots__ = ("lemma", "pos", "filtered", "hash", "__weakref__")
 
-    def __init__(self, tokenDict):
-        self.lemma = tokenDict["lemma"]
-        self.pos = tokenDict["pos"]
-        self.posprob = tokenDict["posprob"]
+    table = weakref.WeakValueDictionary()
+
+    def __init__(self, lemma, pos):
+        self.lemma = sys.intern(lemma)
+        self.pos = pos
+        self.filtered = is_filtered(lemma, pos)
+        self.hash = hash(self.lemma)
+
+    @classmethod
+    def get(cls, lemma, pos):
+        token = cls.table.get((lemma, pos))
+        if token is None:
+            token = cls.table[(lemma, pos)] = cls(lemma, pos)
+        return token
 
     def __hash__(self):
-        return hash(self.lemma)
+        return self.hash
 
     def __eq__(self, other):
-        return self.lemma == other.lemma
+        return self is other or self.lemma == other.lemma
+
+    def __reduce__(self):
+        # unpickled tokens are interned too
+        return (Token.get, (self.lemma, self.pos))
+
+    def __setstate__(self, state):
+        # tokens pickled before interning
+        self.__init__(state["lemma"], state["pos"])
 
     def filter_token(self):
-        pos_to_filter = ["BW", "LET", "LID", "VG", "TSW", "VZ", "VNW"]
-        match = False
-        for ptag in pos_to_filter:
-            if ptag in self.pos:
-                match = True
-                break
-        if match:
-            return True
-        elif ("http" in self.lemma.lower() or self.lemma.lower() in stop_words):
-            return True
-        else:
-            return False
+        return self.filtered
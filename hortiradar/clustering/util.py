@@ -1,9 +1,16 @@
 from datetime import datetime, timedelta
 
 import numpy as np
+from scipy import sparse
 from sklearn.metrics.pairwise import cosine_similarity
 
 
+# Stories.is_similar and story_similarities round the similarities of stories and
+# clusters to this many decimals, so the floating point error of their different
+# sums doesn't change the threshold tests or which of the equal stories is matched
+decimals = 12
+
+
 def round_time(dt, interval="hour", rounding="floor"):
     if rounding == "ceil":
         if interval == "hour":
@@ -59,3 +66,27 @@ def cos_sim(a, b):
             return 0.0
 
     return cosine_similarity(a, b)[0][0]
+
+
+def best_tweet(tokens, filt_tokens, tweets, retweets):
+    """The tweet with the highest cosine similarity to the token counts over the
+    filtered tokens, times the square root of its number of retweets, or None.
+    The similarities of all tweets are one sparse matrix-vector product."""
+    tweets = list(tweets)
+    if not tweets:
+        return None
+    vocabulary = {t.lemma: i for (i, t) in enumerate(filt_tokens)}
+    centroid = np.array([tokens[t] for t in filt_tokens], dtype=np.float64)
+    indptr = [0]
+    indices = []
+    for tw in tweets:
+        indices.extend(vocabulary[t.lemma] for t in tw.tokens if t.lemma in vocabulary)
+        indptr.append(len(indices))
+    M = sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(tweets), len(vocabulary)))
+    M.sum_duplicates()
+
+    norms = np.sqrt(M.multiply(M).sum(axis=1)).A1 * np.linalg.norm(centroid)
+    similarities = np.divide(M @ centroid, norms, out=np.zeros(len(tweets)), where=norms > 0)
+    boost = np.array([np.sqrt(len(retweets[tw.tweet.id_str])) if tw.tweet.id_str in retweets else 1.0
+                      for tw in tweets])
+    return tweets[np.argmax(similarities * boost)]
@@ -1,11 +1,19 @@
-from collections import Counter
+from collections import Counter, defaultdict
 from datetime import datetime, timedelta
-from time import time
+from time import perf_counter, time
 
 import falcon
 import ujson as json
 
+from api_cache import CacheMiddleware
+from api_columnar import ARROW_STREAM, keyword_table, pa
+from api_compression import CompressionMiddleware
+from api_metrics import MetricsMiddleware, render
+from api_slowlog import clear, log_query, worst_queries
+from invalidation import invalidate_tweets
 from keywords import get_db, get_keywords
+from rollups import get_rollups, hll_precision, mark_dirty, rolled_up_hours, user_counters, word_counters
+from sketches import HyperLogLog, merge_top_k
 from hortiradar import admins, users, time_format
 from hortiradar.database import stop_words
 from hortiradar.clustering import Config
@@ -18,9 +26,20 @@ groups = db.groups
 KEYWORDS = get_keywords(local=True)
 keywords_sync_time = time()
 
+
+def get_groups(keywords):
+    """Maps the groups to the set of their keywords."""
+    groups = defaultdict(set)
+    for (lemma, kw) in keywords.items():
+        for g in kw.groups:
+            groups[g].add(lemma)
+    return groups
+
+GROUPS = get_groups(KEYWORDS)
+
 spam_level = Config.getfloat("database:parameters", "spam_level")
 
-def get_dates(req, resp, resource, params):
+def parse_dates(req):
     """Parse the `start` and `end` datetime parameters."""
     try:
         today = datetime.today()
@@ -35,30 +54,109 @@ def get_dates(req, resp, resource, params):
             end = datetime.strptime(end, time_format)
         else:
             end = today
-        params["start"] = start
-        params["end"] = end
     except ValueError:
         msg = "Invalid datetime format string, use: %s" % time_format
-        raise falcon.HTTPBadRequest("Bad request", msg)
+        raise falcon.HTTPBadRequest(title="Bad request", description=msg)
+    return start, end
+
+def get_dates(req, resp, resource, params):
+    params["start"], params["end"] = parse_dates(req)
 
 def want_spam(req):
     return req.get_param("spam") == '1'
 
-def is_spam(t):
-    return t.get("spam") is not None and t["spam"] > spam_level
-
+def keyword_query(req, keyword, start, end):
+    """The query for tweets matching keyword from start to end.
+    Spam is excluded in the query itself, so MongoDB never returns spam
+    documents, unless the `spam` GET parameter is set.
+    """
+    query = {
+        "keywords": keyword,
+        "datetime": {"$gte": start, "$lt": end}
+    }
+    if not want_spam(req):
+        # also matches tweets without a spam score
+        query["spam"] = {"$not": {"$gt": spam_level}}
+    return query
+
+def tracked_keywords():
+    """The tracked keywords, refreshed every hour."""
+    global KEYWORDS, GROUPS, keywords_sync_time
+    if (time() - keywords_sync_time) > 60 * 60:
+        KEYWORDS = get_keywords(local=True)
+        GROUPS = get_groups(KEYWORDS)
+        keywords_sync_time = time()
+    return KEYWORDS
+
+def tracked_groups():
+    """The groups with their keywords, refreshed with the tracked keywords."""
+    tracked_keywords()
+    return GROUPS
+
+
+class QueryResource:
+    """A resource answering GET requests with a single query on the tweets.
+    Subclasses implement `query`, returning the filter and projection, and
+    `result`, building the response data from the matching documents. The ASGI
+    server in api_asgi.py runs the same methods on the async driver.
+
+    Resources with an `arrow` method also respond in the columnar Arrow IPC
+    format with the "format=arrow" GET parameter. Resources with a
+    `from_rollups` method first try to build the result from the hourly
+    rollups (rollups.py), it returns None if that's not possible.
+    """
 
-class KeywordsResource:
     @falcon.before(get_dates)
-    def on_get(self, req, resp, start, end):
-        """All tracked keywords in the database.
-        Returns a sorted list with the keywords and their counts.
-        Takes the "group" GET parameters for the keyword group.
-        """
-        global KEYWORDS, keywords_sync_time
-        if (time() - keywords_sync_time) > 60 * 60:
-            KEYWORDS = get_keywords(local=True)
-            keywords_sync_time = time()
+    def on_get(self, req, resp, start, end, **params):
+        self.respond(resp, self.get(req, start, end, **params))
+
+    def get(self, req, start, end, **params):
+        """The result as Python objects, or as bytes in the Arrow format. The
+        in-process transport (api_local.py) uses it without serialisation."""
+        if hasattr(self, "from_rollups"):
+            result = self.from_rollups(req, start, end, **params)
+            if result is not None:
+                return result
+        query, projection = self.query(req, start, end, **params)
+        t = perf_counter()
+        tw = tweets.find(query, projection=projection)
+        result = self.build(req, tw, start, end, params)
+        req.context.documents = tw.retrieved
+        # the cursor is consumed while building the result, so that's included
+        log_query(type(self).__name__, query, projection, perf_counter() - t)
+        return result
+
+    def build(self, req, tw, start, end, params):
+        if want_arrow(req, self):
+            return self.arrow(req, tw, start, end, **params)
+        return self.result(req, tw, start, end, **params)
+
+    @staticmethod
+    def respond(resp, result):
+        if isinstance(result, bytes):
+            resp.data = result
+            resp.content_type = ARROW_STREAM
+        else:
+            resp.text = json.dumps(result)
+
+def want_arrow(req, resource):
+    if req.get_param("format", default="json") == "json":
+        return False
+    if req.get_param("format") != "arrow" or not hasattr(resource, "arrow"):
+        raise falcon.HTTPBadRequest(title="Bad request", description="Unsupported format for this resource.")
+    if pa is None:
+        raise falcon.HTTPBadRequest(title="Bad request", description="The Arrow format is not available.")
+    return True
+
+class KeywordsResource(QueryResource):
+    """All tracked keywords in the database.
+    Returns a sorted list with the keywords and their counts.
+    Takes the "group" GET parameters for the keyword group. With the "by_group"
+    GET parameter it returns the lists of all groups in an object, from one pass
+    over the tweets.
+    """
+
+    def query(self, req, start, end):
         query = {
             "num_keywords": {"$gt": 0},
             "datetime": {"$gte": start, "$lt": end}
@@ -67,27 +165,34 @@ class KeywordsResource:
         if group:
             del query["num_keywords"]
             query["groups"] = group
-        tw = tweets.find(query, projection={"keywords": True, "_id": False})
+        return query, {"keywords": True, "_id": False}
+
+    def result(self, req, tw, start, end):
+        tracked = tracked_keywords()
+        group = req.get_param("group")
         counts = Counter()
         for t in tw:
             kws = t["keywords"]
             if group:
                 keywords = []
                 for kw in kws:
-                    if kw in KEYWORDS:
-                        if group in KEYWORDS[kw].groups:
+                    if kw in tracked:
+                        if group in tracked[kw].groups:
                             keywords.append(kw)
                 kws = keywords
             counts.update(kws)
-        data = [{"keyword": kw, "count": c} for kw, c in counts.most_common()]
-        resp.body = json.dumps(data)
+        if req.get_param_as_bool("by_group") and not group:
+            ranked = counts.most_common()
+            return {g: [{"keyword": kw, "count": c} for kw, c in ranked if kw in kws]
+                    for (g, kws) in tracked_groups().items()}
+        return [{"keyword": kw, "count": c} for kw, c in counts.most_common()]
 
 class GroupsResource:
     def on_get(self, req, resp):
         """The groups currently tagged in the database."""
         gs = groups.find({}, projection={"name": True, "_id": False})
         group_names = [g["name"] for g in gs]
-        resp.body = json.dumps(group_names)
+        resp.text = json.dumps(group_names)
 
     def on_post(self, req, resp):
         """Add a new group to the system."""
@@ -106,7 +211,7 @@ class GroupResource:
             data = g["keywords"]
         except KeyError:
             data = []
-        resp.body = json.dumps(data)
+        resp.text = json.dumps(data)
 
     def on_put(self, req, resp, group):
         """Update group wordlist."""
@@ -119,188 +224,301 @@ class GroupResource:
     def on_delete(self, req, resp, group):
         groups.delete_one({"name": group})
 
-class KeywordResource:
-    @falcon.before(get_dates)
-    def on_get(self, req, resp, keyword, start, end):
-        """NLP analysis of the tweet text, entities and timestamp of tweets matching keyword."""
-        tw = tweets.find({
-            "keywords": keyword,
-            "datetime": {"$gte": start, "$lt": end}
-        }, projection={
+class KeywordResource(QueryResource):
+    """NLP analysis of the tweet text, entities and timestamp of tweets matching keyword."""
+
+    def query(self, req, start, end, keyword):
+        if want_arrow(req, self):
+            return keyword_query(req, keyword, start, end), {
+                "tweet.id_str": True, "datetime": True, "tweet.user.id_str": True,
+                "tweet.retweeted_status.id_str": True, "tweet.retweeted_status.user.id_str": True,
+                "tweet.retweeted_status.retweet_count": True, "tokens.lemma": True, "tokens.pos": True,
+                "_id": False
+            }
+        return keyword_query(req, keyword, start, end), {
             "tweet.id_str": True, "tokens": True, "tweet.entities": True, "tweet.created_at": True,
             "tweet.user.id_str": True, "tweet.user.screen_name": True, "tweet.retweeted_status.user.id_str": True,
             "tweet.retweeted_status.user.screen_name": True, "tweet.retweeted_status.id_str": True,
             "tweet.in_reply_to_user_id_str": True, "tweet.in_reply_to_screen_name": True,
             "tweet.retweeted_status.retweet_count": True,
-            "spam": True, "_id": False
-        })
-        if not want_spam(req):
-            tw = [t for t in tw if not is_spam(t)]
-        resp.body = json.dumps(tw)
+            "_id": False
+        }
 
-class KeywordIdsResource:
-    @falcon.before(get_dates)
-    def on_get(self, req, resp, keyword, start, end):
-        """A list of the tweet id's matching keyword."""
-        tw = tweets.find({
-            "keywords": keyword,
-            "datetime": {"$gte": start, "$lt": end}
-        }, projection={"tweet.id_str": True, "spam": True, "_id": False})
-        if want_spam(req):
-            data = [t["tweet"]["id_str"] for t in tw]
-        else:
-            data = [t["tweet"]["id_str"] for t in tw if not is_spam(t)]
-        resp.body = json.dumps(data)
+    def result(self, req, tw, start, end, keyword):
+        return list(tw)
 
-class KeywordMediaResource:
-    @falcon.before(get_dates)
-    def on_get(self, req, resp, keyword, start, end):
-        """List of the media entities for tweets matching keyword."""
-        tw = tweets.find({
-            "keywords": keyword,
-            "datetime": {"$gte": start, "$lt": end}
-        }, projection={"tweet.id_str": True, "tweet.entities.media": True, "spam": True, "_id": False})
+    def arrow(self, req, tw, start, end, keyword):
+        return keyword_table(tw)
+
+class KeywordIdsResource(QueryResource):
+    """A list of the tweet id's matching keyword."""
+
+    def query(self, req, start, end, keyword):
+        return keyword_query(req, keyword, start, end), {"tweet.id_str": True, "_id": False}
+
+    def result(self, req, tw, start, end, keyword):
+        return [t["tweet"]["id_str"] for t in tw]
+
+class KeywordMediaResource(QueryResource):
+    """List of the media entities for tweets matching keyword."""
+
+    def query(self, req, start, end, keyword):
         # alternative:  "tweet.entities.media": {"$ne": None} in query
-        if want_spam(req):
-            data = [t["tweet"] for t in tw if "media" in t["tweet"]["entities"]]
-        else:
-            data = [t["tweet"] for t in tw if "media" in t["tweet"]["entities"] if not is_spam(t)]
-        resp.body = json.dumps(data)
+        return keyword_query(req, keyword, start, end), {"tweet.id_str": True, "tweet.entities.media": True, "_id": False}
 
-class KeywordUrlsResource:
-    @falcon.before(get_dates)
-    def on_get(self, req, resp, keyword, start, end):
-        """List of the urls entities for tweets matching keyword."""
-        tw = tweets.find({
-            "keywords": keyword,
-            "datetime": {"$gte": start, "$lt": end}
-        }, projection={"tweet.entities.urls": True, "tweet.id_str": True, "spam": True, "_id": False})
+    def result(self, req, tw, start, end, keyword):
+        return [t["tweet"] for t in tw if "media" in t["tweet"]["entities"]]
+
+class KeywordUrlsResource(QueryResource):
+    """List of the urls entities for tweets matching keyword."""
+
+    def query(self, req, start, end, keyword):
         # "tweet.entities.urls": {"$ne": []}
-        if want_spam(req):
-            data = [t["tweet"] for t in tw if t["tweet"]["entities"]["urls"]]
-        else:
-            data = [t["tweet"] for t in tw if t["tweet"]["entities"]["urls"] if not is_spam(t)]
-        resp.body = json.dumps(data)
+        return keyword_query(req, keyword, start, end), {"tweet.entities.urls": True, "tweet.id_str": True, "_id": False}
 
-class KeywordTextsResource:
-    @falcon.before(get_dates)
-    def on_get(self, req, resp, keyword, start, end):
-        "List of the tweet texts of keyword."
-        tw = tweets.find({
-            "keywords": keyword,
-            "datetime": {"$gte": start, "$lt": end},
-        }, projection={"tweet.text": True, "tweet.id_str": True, "spam": True, "_id": False})
-        if want_spam(req):
-            data = [t["tweet"] for t in tw]
-        else:
-            data = [t["tweet"] for t in tw if not is_spam(t)]
-        resp.body = json.dumps(data)
+    def result(self, req, tw, start, end, keyword):
+        return [t["tweet"] for t in tw if t["tweet"]["entities"]["urls"]]
 
-class KeywordUsersResource:
-    @falcon.before(get_dates)
-    def on_get(self, req, resp, keyword, start, end):
-        """List of users who tweeted keyword.
-        Returns a sorted list with tuples of the user id and the number of tweets.
-        """
-        tw = tweets.find({
-            "keywords": keyword,
-            "datetime": {"$gte": start, "$lt": end},
-        }, projection={"tweet.user.id_str": True, "spam": True, "_id": False})
+class KeywordTextsResource(QueryResource):
+    "List of the tweet texts of keyword."
+
+    def query(self, req, start, end, keyword):
+        return keyword_query(req, keyword, start, end), {"tweet.text": True, "tweet.id_str": True, "_id": False}
+
+    def result(self, req, tw, start, end, keyword):
+        return [t["tweet"] for t in tw]
+
+class KeywordUsersResource(QueryResource):
+    """List of users who tweeted keyword.
+    Returns a sorted list with tuples of the user id and the number of tweets.
+    Takes the "n" GET parameter for only the top n users.
+    """
+
+    projection = {"tweet.user.id_str": True, "_id": False}
+
+    def query(self, req, start, end, keyword):
+        return keyword_query(req, keyword, start, end), self.projection
+
+    def result(self, req, tw, start, end, keyword):
         counts = Counter()
-        skip_spam = not want_spam(req)
         for t in tw:
-            if skip_spam and is_spam(t):
-                continue
             counts[t["tweet"]["user"]["id_str"]] += 1
-        data = [{"id_str": id_str, "count": c} for id_str, c in counts.most_common()]
-        resp.body = json.dumps(data)
-
-class KeywordWordcloudResource:
-    @falcon.before(get_dates)
-    def on_get(self, req, resp, keyword, start, end):
-        """Returns words and their counts in all tweets for keyword."""
-        tw = tweets.find({
-            "keywords": keyword,
-            "datetime": {"$gte": start, "$lt": end},
-        }, projection={"tokens.lemma": True, "spam": True, "_id": False})
-        words = Counter()
-        skip_spam = not want_spam(req)
+        return [{"id_str": id_str, "count": c} for id_str, c in counts.most_common(req.get_param_as_int("n", min_value=1))]
+
+    def from_rollups(self, req, start, end, keyword):
+        """Merges the heavy hitters of the hourly rollups. Returns the top
+        `user_counters` users, their counts may be too low by the summed
+        decrements of the rollups."""
+        merged = merge_rollups(req, [keyword], start, end, "users", user_counters, self.projection,
+                               lambda t: [t["tweet"]["user"]["id_str"]])
+        if merged is None:
+            return None
+        return [{"id_str": id_str, "count": c} for id_str, c in merged[keyword].most_common(req.get_param_as_int("n", min_value=1))]
+
+class KeywordUserCountResource(QueryResource):
+    """Number of distinct users who tweeted keyword.
+    Returns {"count": n}, estimated with HyperLogLog over the hourly rollups.
+    """
+
+    projection = {"tweet.user.id_str": True, "_id": False}
+
+    def query(self, req, start, end, keyword):
+        return keyword_query(req, keyword, start, end), self.projection
+
+    def result(self, req, tw, start, end, keyword):
+        return {"count": len({t["tweet"]["user"]["id_str"] for t in tw})}
+
+    def from_rollups(self, req, start, end, keyword):
+        hours = rolled_up_hours(start, end)
+        if hours is None or want_spam(req):
+            return None
+        hll = HyperLogLog(hll_precision)
+        for r in get_rollups([keyword], *hours, "users"):
+            if "hll" in r["users"]:
+                hll.merge(HyperLogLog(hll_precision, r["users"]["hll"]))
+            else:               # the counts contain all users
+                hll.update(id_str for (id_str, _) in r["users"]["counts"])
+        hll.update(t["tweet"]["user"]["id_str"] for t in scan_edges(req, keyword, start, end, hours, self.projection))
+        return {"count": hll.count()}
+
+def scan_edges(req, keyword, start, end, hours, projection):
+    """The tweets in [start, end) outside of the rolled up hours."""
+    for (s, e) in [(start, hours[0]), (hours[1], end)]:
+        if s < e:
+            yield from tweets.find(keyword_query(req, keyword, s, e), projection=projection)
+
+def merge_rollups(req, keywords, start, end, field, k, projection, items):
+    """Merges the `field` summaries of the hourly rollups of the keywords into a
+    summary of k counters per keyword. The tweets outside of the whole hours
+    are counted exactly with `items(t)`. Returns {keyword: Counter}, or None
+    without rollups for the window.
+    """
+    hours = rolled_up_hours(start, end)
+    if hours is None or want_spam(req):
+        return None
+    summaries = defaultdict(list)
+    for r in get_rollups(keywords, *hours, field):
+        summaries[r["keyword"]].append((dict(r[field]["counts"]), r[field]["decrement"]))
+    wanted = set(keywords)
+    edges = defaultdict(Counter)
+    projection = dict(projection, keywords=True)
+    for t in scan_edges(req, {"$in": keywords}, start, end, hours, projection):
+        for kw in t["keywords"]:
+            if kw in wanted:
+                edges[kw].update(items(t))
+    for (kw, counts) in edges.items():
+        summaries[kw].append((counts, 0))
+    return {kw: Counter(merge_top_k(summaries[kw], k)[0]) for kw in keywords}
+
+def words(t):
+    """The lemmas of the tweet without stop words."""
+    return [token["lemma"] for token in t["tokens"] if token["lemma"].lower() not in stop_words]
+
+class KeywordWordcloudResource(QueryResource):
+    """Returns words and their counts in all tweets for keyword."""
+
+    projection = {"tokens.lemma": True, "_id": False}
+
+    def query(self, req, start, end, keyword):
+        return keyword_query(req, keyword, start, end), self.projection
+
+    def result(self, req, tw, start, end, keyword):
+        counts = Counter()
         for t in tw:
-            if skip_spam and is_spam(t):
-                continue
-            lemmas = [token["lemma"] for token in t["tokens"]]
-            words.update([l for l in lemmas if l.lower() not in stop_words])
-        data = [{"word": w, "count": c} for w, c in words.most_common()]
-        resp.body = json.dumps(data)
-
-class KeywordTimeSeriesResource:
-    @falcon.before(get_dates)
-    def on_get(self, req, resp, keyword, start, end):
-        """Returns a time series with number of tweets from start to end in bins of step.
-        Step is a mandatory GET parameter: number of seconds as an integer.
-
-        Returns an object where:
-            - start is the beginning of the first bin
-            - end is the end of the last bin (so nothing was counted after this time)
-            - step is the requested time bin size
-            - bins is the number of filled bins
-            - series is an object where the keys are the bin numbers and the values the counts
-        """
-        tw = tweets.find({
-            "keywords": keyword,
-            "datetime": {"$gte": start, "$lt": end},
-        }, projection={"datetime": True, "_id": False}).sort("datetime")
-        step = req.get_param("step")
-        try:
-            dt = timedelta(seconds=int(step))
-        except (ValueError, TypeError):
-            msg = "Invalid step: step is an integer of the number of seconds."
-            raise falcon.HTTPBadRequest("Bad request", msg)
-        try:
-            first = tw[0]["datetime"]
-        except IndexError:
-            # empty time series
-            data = {
-                "start": start.strftime(time_format),
-                "end": end.strftime(time_format),
-                "step": int(step),
-                "bins": 0,
-                "series": {}
-            }
-            resp.body = json.dumps(data)
-            return
-        steps_until_first = int((first - start).total_seconds() // dt.total_seconds())
-        start = start + steps_until_first * dt
-        i = 0
-        series = Counter()
-        skip_spam = not want_spam(req)
+            counts.update(words(t))
+        return [{"word": w, "count": c} for w, c in counts.most_common()]
+
+    def from_rollups(self, req, start, end, keyword):
+        """Merges the top `word_counters` lemmas of the hourly rollups."""
+        merged = merge_rollups(req, [keyword], start, end, "words", word_counters, self.projection, words)
+        if merged is None:
+            return None
+        return [{"word": w, "count": c} for w, c in merged[keyword].most_common()]
+
+class KeywordTimeSeriesResource(QueryResource):
+    """Returns a time series with number of tweets from start to end in bins of step.
+    Step is a mandatory GET parameter: number of seconds as an integer.
+
+    Returns an object where:
+        - start is the beginning of the first bin
+        - end is the end of the last bin (so nothing was counted after this time)
+        - step is the requested time bin size
+        - bins is the number of filled bins
+        - series is an object where the keys are the bin numbers and the values the counts
+    """
+
+    def query(self, req, start, end, keyword):
+        get_step(req)
+        return keyword_query(req, keyword, start, end), {"datetime": True, "_id": False}
+
+    def result(self, req, tw, start, end, keyword):
+        return time_series([t["datetime"] for t in tw], start, end, get_step(req))
+
+class SeriesResource(QueryResource):
+    """Time series of many keywords with one query, see KeywordTimeSeriesResource.
+    Takes the "keywords" GET parameter with a comma separated list of
+    keywords, without it all tracked keywords are counted.
+    Returns an object with the keywords as keys and their time series as values.
+    """
+
+    def query(self, req, start, end):
+        get_step(req)
+        keywords = get_keyword_list(req)
+        return keyword_query(req, {"$in": keywords}, start, end), {"keywords": True, "datetime": True, "_id": False}
+
+    def result(self, req, tw, start, end):
+        step = get_step(req)
+        keywords = get_keyword_list(req)
+        wanted = set(keywords)
+        datetimes = {kw: [] for kw in keywords}
+        for t in tw:
+            for kw in t["keywords"]:
+                if kw in wanted:
+                    datetimes[kw].append(t["datetime"])
+        return {kw: time_series(datetimes[kw], start, end, step) for kw in keywords}
+
+class WordcloudsResource(QueryResource):
+    """Word clouds of many keywords with one query, see KeywordWordcloudResource.
+    Takes the "keywords" GET parameter like SeriesResource.
+    Returns an object with the keywords as keys and their word clouds as values.
+    """
+
+    def query(self, req, start, end):
+        keywords = get_keyword_list(req)
+        return keyword_query(req, {"$in": keywords}, start, end), {"keywords": True, "tokens.lemma": True, "_id": False}
+
+    def result(self, req, tw, start, end):
+        keywords = get_keyword_list(req)
+        wanted = set(keywords)
+        counts = {kw: Counter() for kw in keywords}
         for t in tw:
-            if skip_spam and is_spam(t):
-                continue
-            while not t["datetime"] < start + (i + 1) * dt:
-                i += 1
-            series[i] += 1
-        last = max(series.keys())
-        data = {
+            lemmas = words(t)
+            for kw in t["keywords"]:
+                if kw in wanted:
+                    counts[kw].update(lemmas)
+        return {kw: [{"word": w, "count": c} for w, c in counts[kw].most_common()] for kw in keywords}
+
+    def from_rollups(self, req, start, end):
+        keywords = get_keyword_list(req)
+        merged = merge_rollups(req, keywords, start, end, "words", word_counters, {"tokens.lemma": True, "_id": False}, words)
+        if merged is None:
+            return None
+        return {kw: [{"word": w, "count": c} for w, c in merged[kw].most_common()] for kw in keywords}
+
+
+def get_step(req):
+    """Parse the mandatory `step` parameter: number of seconds as an integer."""
+    try:
+        step = int(req.get_param("step"))
+        if step <= 0:
+            raise ValueError
+    except (ValueError, TypeError):
+        msg = "Invalid step: step is an integer of the number of seconds."
+        raise falcon.HTTPBadRequest(title="Bad request", description=msg)
+    return step
+
+def get_keyword_list(req):
+    """The keywords in the `keywords` parameter, or all tracked keywords."""
+    keywords = req.get_param_as_list("keywords")
+    if keywords:
+        return sorted(set(kw for kw in keywords if kw))
+    return sorted(tracked_keywords())
+
+def time_series(datetimes, start, end, step):
+    """Bins datetimes in bins of step seconds, the bins are aligned to start."""
+    if not datetimes:
+        return {
             "start": start.strftime(time_format),
-            "end": (start + (last + 1) * dt).strftime(time_format),
-            "step": int(step),
-            "bins": len(series),
-            "series": series
+            "end": end.strftime(time_format),
+            "step": step,
+            "bins": 0,
+            "series": {}
         }
-        resp.body = json.dumps(data)
+    dt = timedelta(seconds=step)
+    steps_until_first = int((min(datetimes) - start).total_seconds() // step)
+    start = start + steps_until_first * dt
+    series = Counter(int((d - start).total_seconds() // step) for d in datetimes)
+    last = max(series.keys())
+    return {
+        "start": start.strftime(time_format),
+        "end": (start + (last + 1) * dt).strftime(time_format),
+        "step": step,
+        "bins": len(series),
+        "series": series
+    }
 
 class TweetResource:
     def on_get(self, req, resp, id_str):
         t = tweets.find_one({"tweet.id_str": id_str}, projection={"datetime": False, "_id": False})
         if t:
-            resp.body = json.dumps(t)
+            resp.text = json.dumps(t)
         else:
             raise falcon.HTTPNotFound()
 
     def on_delete(self, req, resp, id_str):
-        t = tweets.delete_one({"tweet.id_str": id_str})
-        if t.deleted_count > 0:
+        t = tweets.find_one_and_delete({"tweet.id_str": id_str}, projection={"keywords": True, "datetime": True})
+        if t:
+            forget_tweets([t])
             resp.status = falcon.HTTP_204
         else:
             raise falcon.HTTPNotFound()
@@ -312,21 +530,102 @@ class TweetResource:
             patch = json.loads(data)
         except ValueError as e:
             msg = "Invalid JSON: " + str(e)
-            raise falcon.HTTPBadRequest("Bad request", msg)
-        t = tweets.find_one({"tweet.id_str": id_str}, projection={"_id": True})
+            raise falcon.HTTPBadRequest(title="Bad request", description=msg)
+        update = json_merge_patch_to_mongo_update(patch)
+        t = tweets.find_one({"tweet.id_str": id_str}, projection={"keywords": True, "datetime": True})
         if not t:
             raise falcon.HTTPNotFound()
-        update = json_merge_patch_to_mongo_update(patch)
         try:
             tweets.update_one({"_id": t["_id"]}, update)
+            mark_dirty([t])
             resp.status = falcon.HTTP_204
         except Exception as e:
             msg = ("Error: {}. ".format(str(e)) +
                    "This endpoint accepts JSON merge patches as specified in https://tools.ietf.org/html/rfc7396")
-            raise falcon.HTTPBadRequest("Bad request", msg)
+            raise falcon.HTTPBadRequest(title="Bad request", description=msg)
 
+class TweetsResource:
+    """Bulk variant of TweetResource. The tweet ids are given in the "ids" GET
+    parameter as a comma separated list, or as the "ids" list in a JSON body.
+    """
+
+    def on_get(self, req, resp):
+        ids = get_ids(req, read_json(req) if req.content_length else {})
+        tw = list(tweets.find({"tweet.id_str": {"$in": ids}}, projection={"datetime": False, "_id": False}))
+        resp.text = json.dumps(tw)
+        req.context.documents = len(tw)
+
+    def on_delete(self, req, resp):
+        ids = get_ids(req, read_json(req) if req.content_length else {})
+        tw = list(tweets.find({"tweet.id_str": {"$in": ids}}, projection={"keywords": True, "datetime": True}))
+        result = tweets.delete_many({"tweet.id_str": {"$in": ids}})
+        forget_tweets(tw)
+        resp.text = json.dumps({"deleted": result.deleted_count})
+
+    def on_patch(self, req, resp):
+        """Apply the JSON merge patch in "patch" to all tweets in "ids" with one update."""
+        body = read_json(req)
+        ids = get_ids(req, body)
+        update = json_merge_patch_to_mongo_update(body.get("patch") or {})
+        if not update:
+            raise falcon.HTTPBadRequest(title="Bad request", description="Missing JSON merge patch in \"patch\".")
+        try:
+            result = tweets.update_many({"tweet.id_str": {"$in": ids}}, update)
+            mark_dirty(tweets.find({"tweet.id_str": {"$in": ids}}, projection={"keywords": True, "datetime": True}))
+        except Exception as e:
+            msg = ("Error: {}. ".format(str(e)) +
+                   "This endpoint accepts JSON merge patches as specified in https://tools.ietf.org/html/rfc7396")
+            raise falcon.HTTPBadRequest(title="Bad request", description=msg)
+        resp.text = json.dumps({"matched": result.matched_count, "modified": result.modified_count})
+
+class MetricsResource:
+    def on_get(self, req, resp):
+        """Request metrics of all API processes in the Prometheus text format."""
+        resp.content_type = "text/plain; version=0.0.4"
+        resp.text = render()
+
+class SlowQueriesResource:
+    def on_get(self, req, resp):
+        """The slowest queries of the resources with their explain() summary.
+        Takes the "n" GET parameter for the number of queries (default 20)."""
+        n = req.get_param_as_int("n", min_value=1) or 20
+        resp.text = json.dumps(worst_queries(n))
+
+    def on_delete(self, req, resp):
+        """Clear the slow query log, e.g. after adding an index."""
+        clear()
+        resp.status = falcon.HTTP_204
+
+
+def read_json(req):
+    try:
+        return json.loads(req.stream.read())
+    except ValueError as e:
+        msg = "Invalid JSON: " + str(e)
+        raise falcon.HTTPBadRequest(title="Bad request", description=msg)
+
+def get_ids(req, body):
+    """The tweet ids from the "ids" GET parameter or the JSON body."""
+    if not isinstance(body, dict):
+        raise falcon.HTTPBadRequest(title="Bad request", description="The body must be a JSON object.")
+    ids = req.get_param_as_list("ids") or body.get("ids") or []
+    if not isinstance(ids, list) or not all(isinstance(i, str) for i in ids):
+        raise falcon.HTTPBadRequest(title="Bad request", description="ids must be a list of tweet id strings.")
+    if not ids:
+        raise falcon.HTTPBadRequest(title="Bad request", description="Missing tweet ids.")
+    return ids
+
+def forget_tweets(tw):
+    """Mark the rollups of deleted tweets dirty and delete the cache entries
+    with their data. The change stream (changes.py) can't invalidate deletes,
+    the delete events don't carry the deleted document."""
+    mark_dirty(tw)
+    invalidate_tweets(tw)
 
 def json_merge_patch_to_mongo_update(patch):
+    """The MongoDB update of a JSON merge patch of top-level attributes."""
+    if not isinstance(patch, dict):
+        raise falcon.HTTPBadRequest(title="Bad request", description="The JSON merge patch must be a JSON object.")
     update = {}
     set_values = []
     unset = []
@@ -342,34 +641,50 @@ def json_merge_patch_to_mongo_update(patch):
     return update
 
 
-class AuthenticationMiddleware:
-    def process_request(self, req, resp):
-        token = req.get_param("token")
-        if token in admins:
-            pass                # admins can access everything
-        elif token in users:
-            p = req.path
-            m = req.method
-            # users may not access:
-            if (p.startswith("/keywords/") and (p.endswith("/texts") or p.count("/") == 2) or  # /keywords/{keyword}, /keywords/{keyword}/texts
-                p.startswith("/tweet/") or  # /tweet/{id_str}
-                p.startswith("/groups/") and m in ["DELETE", "PUT"] or  # PUT/DELETE on /groups/{group}
-                p.startswith("/groups") and m == "POST"):   # POST on /groups
-                raise falcon.HTTPForbidden()
-        else:
+def check_access(token, p, m):
+    """Raises HTTPForbidden if the token may not use method m on path p."""
+    if token in admins:
+        pass                # admins can access everything
+    elif token in users:
+        # users may not access:
+        if (p.startswith("/keywords/") and (p.endswith("/texts") or p.count("/") == 2) or  # /keywords/{keyword}, /keywords/{keyword}/texts
+            p.startswith("/tweet") or  # /tweet/{id_str}, /tweets
+            p in ["/metrics", "/slowqueries"] or
+            p.startswith("/groups/") and m in ["DELETE", "PUT"] or  # PUT/DELETE on /groups/{group}
+            p.startswith("/groups") and m == "POST"):   # POST on /groups
             raise falcon.HTTPForbidden()
+    else:
+        raise falcon.HTTPForbidden()
 
 
-app = application = falcon.API(middleware=AuthenticationMiddleware())
-app.add_route("/keywords", KeywordsResource())
-app.add_route("/groups", GroupsResource())
-app.add_route("/groups/{group}", GroupResource())
-app.add_route("/keywords/{keyword}", KeywordResource())
-app.add_route("/keywords/{keyword}/ids", KeywordIdsResource())
-app.add_route("/keywords/{keyword}/media", KeywordMediaResource())
-app.add_route("/keywords/{keyword}/urls", KeywordUrlsResource())
-app.add_route("/keywords/{keyword}/texts", KeywordTextsResource())
-app.add_route("/keywords/{keyword}/users", KeywordUsersResource())
-app.add_route("/keywords/{keyword}/wordcloud", KeywordWordcloudResource())
-app.add_route("/keywords/{keyword}/series", KeywordTimeSeriesResource())
-app.add_route("/tweet/{id_str}", TweetResource())
+class AuthenticationMiddleware:
+    def process_request(self, req, resp):
+        check_access(req.get_param("token"), req.path, req.method)
+
+
+routes = [
+    ("/keywords", KeywordsResource()),
+    ("/groups", GroupsResource()),
+    ("/groups/{group}", GroupResource()),
+    ("/keywords/{keyword}", KeywordResource()),
+    ("/keywords/{keyword}/ids", KeywordIdsResource()),
+    ("/keywords/{keyword}/media", KeywordMediaResource()),
+    ("/keywords/{keyword}/urls", KeywordUrlsResource()),
+    ("/keywords/{keyword}/texts", KeywordTextsResource()),
+    ("/keywords/{keyword}/users", KeywordUsersResource()),
+    ("/keywords/{keyword}/users/count", KeywordUserCountResource()),
+    ("/keywords/{keyword}/wordcloud", KeywordWordcloudResource()),
+    ("/keywords/{keyword}/series", KeywordTimeSeriesResource()),
+    ("/series", SeriesResource()),
+    ("/wordclouds", WordcloudsResource()),
+    ("/tweet/{id_str}", TweetResource()),
+    ("/tweets", TweetsResource()),
+    ("/metrics", MetricsResource()),
+    ("/slowqueries", SlowQueriesResource()),
+]
+
+app = application = falcon.App(middleware=[
+    MetricsMiddleware(routes), CompressionMiddleware(), AuthenticationMiddleware(), CacheMiddleware(parse_dates)
+])
+for (uri_template, resource) in routes:
+    app.add_route(uri_template, resource)
@@ -0,0 +1,243 @@
+"""The API of api.py as an ASGI app on the async MongoDB driver (Motor).
+
+The CacheMiddleware of api.py is intentionally absent: its Redis and local
+cache lookups block the event loop, so every request is answered from MongoDB
+or the rollups. Changes made through this app still invalidate the cache
+entries of api.py.
+"""
+
+import asyncio
+from functools import partial
+from time import perf_counter
+
+import falcon
+import falcon.asgi
+import ujson as json
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import ExecutionTimeout
+
+from api import QueryResource, SlowQueriesResource, check_access, forget_tweets, get_ids, json_merge_patch_to_mongo_update, parse_dates, routes
+from api_columnar import ARROW_STREAM
+from api_compression import AsyncCompressionMiddleware
+from api_metrics import AsyncMetricsMiddleware, render
+from api_slowlog import log_query
+from rollups import mark_dirty
+from hortiradar.clustering import Config
+
+
+max_pool_size = Config.getint("api:asgi", "max_pool_size")
+min_pool_size = Config.getint("api:asgi", "min_pool_size")
+request_timeout = Config.getfloat("api:asgi", "request_timeout")
+
+mongo = AsyncIOMotorClient(maxPoolSize=max_pool_size, minPoolSize=min_pool_size, serverSelectionTimeoutMS=5000)
+db = mongo.twitter
+tweets = db.tweets
+groups = db.groups
+
+
+def timeout_error():
+    msg = "The request took longer than {:g} seconds.".format(request_timeout)
+    return falcon.HTTPServiceUnavailable(title="Timeout", description=msg, retry_after=int(request_timeout))
+
+async def in_thread(f, *args):
+    """Run f in a thread, for the Redis calls of the sync client."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, f, *args)
+
+async def with_timeout(coroutine):
+    """Run the coroutine within the per-request timeout."""
+    try:
+        return await asyncio.wait_for(coroutine, timeout=request_timeout)
+    except (asyncio.TimeoutError, ExecutionTimeout):
+        raise timeout_error()
+
+
+class AsyncQueryResource:
+    """Runs a QueryResource from api.py on the async driver. Building the
+    result is CPU-bound, so it runs in a thread to keep the event loop free
+    for other requests.
+    """
+
+    def __init__(self, resource):
+        self.resource = resource
+
+    async def on_get(self, req, resp, **params):
+        await with_timeout(self.get(req, resp, **params))
+
+    async def get(self, req, resp, **params):
+        start, end = parse_dates(req)
+        loop = asyncio.get_event_loop()
+        if hasattr(self.resource, "from_rollups"):
+            # the rollups are read with the sync driver in a thread
+            result = await loop.run_in_executor(None, partial(self.resource.from_rollups, req, start, end, **params))
+            if result is not None:
+                resp.text = json.dumps(result)
+                return
+        query, projection = self.resource.query(req, start, end, **params)
+        t = perf_counter()
+        cursor = tweets.find(query, projection=projection, max_time_ms=int(request_timeout * 1000))
+        tw = await cursor.to_list(length=None)
+        req.context.documents = len(tw)
+        result = await loop.run_in_executor(None, partial(self.resource.build, req, tw, start, end, params))
+        # the same span as QueryResource.get: the query and building the result
+        log_query(type(self.resource).__name__, query, projection, perf_counter() - t)
+        if isinstance(result, bytes):
+            resp.data = result
+            resp.content_type = ARROW_STREAM
+        else:
+            resp.text = json.dumps(result)
+
+class GroupsResource:
+    async def on_get(self, req, resp):
+        """The groups currently tagged in the database."""
+        gs = await groups.find({}, projection={"name": True, "_id": False}).to_list(length=None)
+        resp.text = json.dumps([g["name"] for g in gs])
+
+    async def on_post(self, req, resp):
+        """Add a new group to the system."""
+        name = req.get_param("name")
+        gs = await groups.find({}, projection={"name": True, "_id": False}).to_list(length=None)
+        group_names = [g["name"] for g in gs]
+        if name and name not in group_names:
+            await groups.insert_one({"name": name})
+
+class GroupResource:
+    async def on_get(self, req, resp, group):
+        """List of keywords in the group."""
+        g = await groups.find_one({"name": group})
+        try:
+            data = g["keywords"]
+        except (KeyError, TypeError):
+            data = []
+        resp.text = json.dumps(data)
+
+    async def on_put(self, req, resp, group):
+        """Update group wordlist."""
+        g = await groups.find_one({"name": group})
+        if not g:
+            raise falcon.HTTPNotFound()
+        keywords = json.loads(await req.stream.read())
+        await groups.update_one({"name": group}, {"$set": {"keywords": keywords}})
+
+    async def on_delete(self, req, resp, group):
+        await groups.delete_one({"name": group})
+
+class TweetResource:
+    async def on_get(self, req, resp, id_str):
+        t = await tweets.find_one({"tweet.id_str": id_str}, projection={"datetime": False, "_id": False})
+        if t:
+            resp.text = json.dumps(t)
+        else:
+            raise falcon.HTTPNotFound()
+
+    async def on_delete(self, req, resp, id_str):
+        t = await tweets.find_one_and_delete({"tweet.id_str": id_str}, projection={"keywords": True, "datetime": True})
+        if t:
+            await in_thread(forget_tweets, [t])
+            resp.status = falcon.HTTP_204
+        else:
+            raise falcon.HTTPNotFound()
+
+    async def on_patch(self, req, resp, id_str):
+        """Update value of tweet document. Only allows (un)setting top-level attributes for now."""
+        data = await req.stream.read()
+        try:
+            patch = json.loads(data)
+        except ValueError as e:
+            msg = "Invalid JSON: " + str(e)
+            raise falcon.HTTPBadRequest(title="Bad request", description=msg)
+        update = json_merge_patch_to_mongo_update(patch)
+        t = await tweets.find_one({"tweet.id_str": id_str}, projection={"keywords": True, "datetime": True})
+        if not t:
+            raise falcon.HTTPNotFound()
+        try:
+            await tweets.update_one({"_id": t["_id"]}, update)
+            await in_thread(mark_dirty, [t])
+            resp.status = falcon.HTTP_204
+        except Exception as e:
+            msg = ("Error: {}. ".format(str(e)) +
+                   "This endpoint accepts JSON merge patches as specified in https://tools.ietf.org/html/rfc7396")
+            raise falcon.HTTPBadRequest(title="Bad request", description=msg)
+
+class TweetsResource:
+    """Bulk variant of TweetResource, see api.TweetsResource."""
+
+    async def on_get(self, req, resp):
+        ids = get_ids(req, await read_json(req) if req.content_length else {})
+        tw = await tweets.find({"tweet.id_str": {"$in": ids}}, projection={"datetime": False, "_id": False}).to_list(length=None)
+        resp.text = json.dumps(tw)
+        req.context.documents = len(tw)
+
+    async def on_delete(self, req, resp):
+        ids = get_ids(req, await read_json(req) if req.content_length else {})
+        tw = await tweets.find({"tweet.id_str": {"$in": ids}}, projection={"keywords": True, "datetime": True}).to_list(length=None)
+        result = await tweets.delete_many({"tweet.id_str": {"$in": ids}})
+        await in_thread(forget_tweets, tw)
+        resp.text = json.dumps({"deleted": result.deleted_count})
+
+    async def on_patch(self, req, resp):
+        body = await read_json(req)
+        ids = get_ids(req, body)
+        update = json_merge_patch_to_mongo_update(body.get("patch") or {})
+        if not update:
+            raise falcon.HTTPBadRequest(title="Bad request", description="Missing JSON merge patch in \"patch\".")
+        try:
+            result = await tweets.update_many({"tweet.id_str": {"$in": ids}}, update)
+            await in_thread(mark_dirty, await tweets.find({"tweet.id_str": {"$in": ids}}, projection={"keywords": True, "datetime": True}).to_list(length=None))
+        except Exception as e:
+            msg = ("Error: {}. ".format(str(e)) +
+                   "This endpoint accepts JSON merge patches as specified in https://tools.ietf.org/html/rfc7396")
+            raise falcon.HTTPBadRequest(title="Bad request", description=msg)
+        resp.text = json.dumps({"matched": result.matched_count, "modified": result.modified_count})
+
+class MetricsResource:
+    async def on_get(self, req, resp):
+        resp.content_type = "text/plain; version=0.0.4"
+        loop = asyncio.get_event_loop()
+        resp.text = await loop.run_in_executor(None, render)
+
+class AsyncSlowQueriesResource:
+    """SlowQueriesResource for the ASGI app, the log lives in Redis."""
+
+    def __init__(self):
+        self.resource = SlowQueriesResource()
+
+    async def on_get(self, req, resp):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.resource.on_get, req, resp)
+
+    async def on_delete(self, req, resp):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.resource.on_delete, req, resp)
+
+
+async def read_json(req):
+    try:
+        return json.loads(await req.stream.read())
+    except ValueError as e:
+        msg = "Invalid JSON: " + str(e)
+        raise falcon.HTTPBadRequest(title="Bad request", description=msg)
+
+
+class AuthenticationMiddleware:
+    async def process_request(self, req, resp):
+        check_access(req.get_param("token"), req.path, req.method)
+
+
+async_resources = {
+    "/groups": GroupsResource(),
+    "/groups/{group}": GroupResource(),
+    "/tweet/{id_str}": TweetResource(),
+    "/tweets": TweetsResource(),
+    "/metrics": MetricsResource(),
+    "/slowqueries": AsyncSlowQueriesResource(),
+}
+
+app = application = falcon.asgi.App(middleware=[
+    AsyncMetricsMiddleware(routes), AsyncCompressionMiddleware(), AuthenticationMiddleware()
+])
+for (uri_template, resource) in routes:
+    if isinstance(resource, QueryResource):
+        app.add_route(uri_template, AsyncQueryResource(resource))
+    else:
+        app.add_route(uri_template, async_resources[uri_template])
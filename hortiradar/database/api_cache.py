@@ -0,0 +1,203 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from email.utils import formatdate, parsedate_to_datetime
+from hashlib import md5
+from time import time
+
+import falcon
+import ujson as json
+from redis import StrictRedis
+
+from invalidation import generation, register
+from hortiradar import time_format
+from hortiradar.clustering import Config
+
+
+redis = StrictRedis()
+
+ingest_lag = timedelta(seconds=Config.getint("api:cache", "ingest_lag"))
+closed_cache_time = Config.getint("api:cache", "closed_cache_time")
+open_cache_time = Config.getint("api:cache", "open_cache_time")
+local_cache_size = Config.getint("api:cache", "local_cache_size")
+
+
+class LocalCache:
+    """A small in-process LRU cache with per-entry expiry times."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        try:
+            expires, value = self.entries[key]
+        except KeyError:
+            return None
+        if expires < time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ex):
+        self.entries[key] = (time() + ex, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+cached_routes = ("/keywords", "/series", "/wordclouds")
+
+
+def get_cache_key(req, start, end, closed=True):
+    """The normalised (route, keyword, start, end, step, spam, group, by_group, n, format) key of a request.
+    The keyword is part of the route, or in the `keywords` parameter for batch requests.
+    Every GET parameter that changes the response of a cached route must be in the key.
+    Open windows are keyed by their start and end floored to the minute: clients that
+    ask for the window up to "now" share an entry instead of adding one per second.
+    """
+    if not closed:
+        start, end = floor_minute(start), floor_minute(end)
+    keywords = req.get_param_as_list("keywords") or []
+    k = (
+        req.path,
+        ",".join(sorted(set(keywords))),
+        start.strftime(time_format),
+        end.strftime(time_format),
+        req.get_param("step") or "",
+        "1" if req.get_param("spam") == "1" else "0",
+        req.get_param("group") or "",
+        req.get_param("by_group") or "",
+        req.get_param("n") or "",
+        req.get_param("format") or "json"
+    )
+    return "api:" + md5(json.dumps(k).encode("utf-8")).hexdigest()
+
+def floor_minute(dt):
+    return dt.replace(second=0, microsecond=0)
+
+def cache_tags(req):
+    """The invalidation tags of the data a cached response depends on."""
+    parts = req.path.split("/")
+    if req.path.startswith("/keywords/") and len(parts) > 2:
+        return ["keyword:" + parts[2]]
+    keywords = req.get_param_as_list("keywords")
+    if keywords and req.path != "/keywords":
+        return ["keyword:" + kw for kw in set(keywords)]
+    return ["keywords", "groups"]
+
+def is_closed_window(end):
+    """Windows that end before the ingest lag won't get new tweets anymore."""
+    return end < datetime.utcnow() - ingest_lag
+
+def http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+def weak(etag):
+    return etag[2:] if etag.startswith("W/") else etag
+
+def is_not_modified(req, etag, last_modified):
+    if_none_match = req.get_header("If-None-Match")
+    if if_none_match:
+        # the weak comparison of If-None-Match
+        return weak(etag) in [weak(t.strip()) for t in if_none_match.split(",")] or if_none_match.strip() == "*"
+    if_modified_since = req.get_header("If-Modified-Since")
+    if if_modified_since:
+        try:
+            return parsedate_to_datetime(if_modified_since).timestamp() >= int(last_modified)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+class CacheMiddleware:
+    """Caches the results of the /keywords, /series and /wordclouds resources
+    in-process and in Redis, and answers conditional GET requests with ETag and
+    Last-Modified.
+
+    Windows that ended longer than `ingest_lag` ago don't get new tweets and are
+    cached for `closed_cache_time`, open windows only for `open_cache_time`.
+    Entries are registered for invalidation, changes to the tweets of closed
+    windows (e.g. spam) delete them, see changes.py. Must be placed after the
+    AuthenticationMiddleware, cache hits skip the resources.
+    """
+
+    def __init__(self, parse_dates):
+        self.parse_dates = parse_dates
+        self.local = LocalCache(local_cache_size)
+        self.generation = generation()
+
+    def process_request(self, req, resp):
+        if req.method != "GET" or not req.path.startswith(cached_routes):
+            return
+        try:
+            start, end = self.parse_dates(req)
+        except falcon.HTTPBadRequest:
+            return              # the resource reports the error
+        closed = is_closed_window(end)
+        key = get_cache_key(req, start, end, closed)
+        req.context.cache = (key, closed, start, end)
+
+        current = generation()
+        if current != self.generation:
+            # entries were invalidated in Redis, the local copies may be stale
+            self.local.entries.clear()
+            self.generation = current
+
+        entry = self.local.get(key)
+        if entry is None:
+            stored = redis.hgetall(key)
+            if stored:
+                entry = {k.decode("utf-8"): v for (k, v) in stored.items()}
+                ttl = redis.ttl(key)
+                if ttl and ttl > 0:
+                    self.local.set(key, entry, ttl)
+        if entry is None:
+            return
+
+        self.set_headers(resp, entry, closed)
+        if is_not_modified(req, entry["etag"].decode("utf-8"), entry["last_modified"]):
+            resp.status = falcon.HTTP_304
+        else:
+            resp.data = entry["body"]
+            if entry.get("content_type"):
+                resp.content_type = entry["content_type"].decode("utf-8")
+        resp.complete = True
+        req.context.cache = None
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        cache = getattr(req.context, "cache", None)
+        if not cache or not req_succeeded or resp.status != falcon.HTTP_200:
+            return
+        body = resp.text.encode("utf-8") if resp.text is not None else resp.data
+        if body is None:
+            return
+        key, closed, start, end = cache
+        entry = {
+            "body": body,
+            "content_type": (resp.content_type or "").encode("utf-8"),
+            # weak, the CompressionMiddleware serves the same entry in several encodings
+            "etag": ('W/"%s"' % md5(body).hexdigest()).encode("utf-8"),
+            "last_modified": str(int(time())).encode("utf-8")
+        }
+        cache_time = closed_cache_time if closed else open_cache_time
+        pipe = redis.pipeline()
+        pipe.hmset(key, entry)
+        pipe.expire(key, cache_time)
+        pipe.execute()
+        register(key, cache_tags(req), start, end, cache_time)
+        self.local.set(key, entry, cache_time)
+
+        self.set_headers(resp, entry, closed)
+        if is_not_modified(req, entry["etag"].decode("utf-8"), entry["last_modified"]):
+            resp.status = falcon.HTTP_304
+            resp.text = None
+            resp.data = None
+
+    @staticmethod
+    def set_headers(resp, entry, closed):
+        cache_time = closed_cache_time if closed else open_cache_time
+        resp.set_header("ETag", entry["etag"].decode("utf-8"))
+        resp.set_header("Last-Modified", http_date(int(entry["last_modified"])))
+        # responses depend on the token, so only the client may store them
+        resp.set_header("Cache-Control", "private, max-age=%d" % cache_time)
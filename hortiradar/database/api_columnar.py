@@ -0,0 +1,70 @@
+from calendar import timegm
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+
+
+def tokens_array(offsets, indices, values):
+    """A list<dictionary<int32, string>> array: the tokens of every tweet."""
+    dictionary = pa.DictionaryArray.from_arrays(pa.array(indices, type=pa.int32()), pa.array(values, type=pa.string()))
+    return pa.ListArray.from_arrays(pa.array(offsets, type=pa.int32()), dictionary)
+
+def keyword_table(tw):
+    """Columnar version of /keywords/{keyword} as an Arrow IPC stream.
+
+    Columns (one row per tweet):
+        - id, user_id: tweet and user id as int64
+        - created_at: int64 seconds since the epoch (UTC)
+        - retweet_id, retweet_user_id, retweet_count: int64, 0 if not a retweet
+        - lemmas, pos: lists of dictionary encoded strings with the tokens
+    """
+    ids = []
+    created_at = []
+    user_ids = []
+    retweet_ids = []
+    retweet_user_ids = []
+    retweet_counts = []
+    offsets = [0]
+    lemma_indices = []
+    pos_indices = []
+    lemmas = {}
+    pos = {}
+    for t in tw:
+        tweet = t["tweet"]
+        ids.append(int(tweet["id_str"]))
+        created_at.append(timegm(t["datetime"].utctimetuple()))
+        user_ids.append(int(tweet["user"]["id_str"]))
+        rt = tweet.get("retweeted_status")
+        if rt:
+            retweet_ids.append(int(rt["id_str"]))
+            retweet_user_ids.append(int(rt["user"]["id_str"]))
+            retweet_counts.append(rt.get("retweet_count", 0))
+        else:
+            retweet_ids.append(0)
+            retweet_user_ids.append(0)
+            retweet_counts.append(0)
+        for token in t["tokens"]:
+            lemma_indices.append(lemmas.setdefault(token["lemma"], len(lemmas)))
+            pos_indices.append(pos.setdefault(token["pos"], len(pos)))
+        offsets.append(len(lemma_indices))
+
+    table = pa.Table.from_arrays([
+        pa.array(ids, type=pa.int64()),
+        pa.array(created_at, type=pa.int64()),
+        pa.array(user_ids, type=pa.int64()),
+        pa.array(retweet_ids, type=pa.int64()),
+        pa.array(retweet_user_ids, type=pa.int64()),
+        pa.array(retweet_counts, type=pa.int64()),
+        tokens_array(offsets, lemma_indices, list(lemmas)),
+        tokens_array(offsets, pos_indices, list(pos)),
+    ], names=["id", "created_at", "user_id", "retweet_id", "retweet_user_id", "retweet_count", "lemmas", "pos"])
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
@@ -0,0 +1,86 @@
+import asyncio
+import gzip
+
+from hortiradar.clustering import Config
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+min_size = Config.getint("api:compression", "min_size")
+gzip_level = Config.getint("api:compression", "gzip_level")
+zstd_level = Config.getint("api:compression", "zstd_level")
+
+if zstandard:
+    zstd_compressor = zstandard.ZstdCompressor(level=zstd_level)
+
+
+def accepted_encodings(req):
+    """The content codings in the Accept-Encoding header that aren't refused with q=0."""
+    header = req.get_header("Accept-Encoding") or ""
+    encodings = set()
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        params = params.replace(" ", "")
+        if params in ["q=0", "q=0.0", "q=0.00", "q=0.000"]:
+            continue
+        encodings.add(coding.strip().lower())
+    return encodings
+
+def choose_encoding(req):
+    encodings = accepted_encodings(req)
+    if zstandard and "zstd" in encodings:
+        return "zstd"
+    elif "gzip" in encodings:
+        return "gzip"
+    return None
+
+def compress(data, encoding):
+    if encoding == "zstd":
+        return zstd_compressor.compress(data)
+    else:
+        return gzip.compress(data, compresslevel=gzip_level)
+
+
+class CompressionMiddleware:
+    """Compresses response bodies of at least `min_size` bytes with zstd or gzip,
+    as negotiated with the Accept-Encoding header. Must be the first middleware,
+    so it compresses the final response after the other middleware.
+    """
+
+    def process_request(self, req, resp):
+        req.context.encoding = choose_encoding(req)
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        resp.append_header("Vary", "Accept-Encoding")
+        encoding = getattr(req.context, "encoding", None)
+        if encoding is None:
+            return
+        data = resp.text.encode("utf-8") if resp.text is not None else resp.data
+        if data is None or len(data) < min_size:
+            return
+        resp.text = None
+        resp.data = compress(data, encoding)
+        resp.set_header("Content-Encoding", encoding)
+
+
+class AsyncCompressionMiddleware:
+    """CompressionMiddleware for the ASGI app."""
+
+    async def process_request(self, req, resp):
+        req.context.encoding = choose_encoding(req)
+
+    async def process_response(self, req, resp, resource, req_succeeded):
+        resp.append_header("Vary", "Accept-Encoding")
+        encoding = getattr(req.context, "encoding", None)
+        if encoding is None:
+            return
+        data = resp.text.encode("utf-8") if resp.text is not None else resp.data
+        if data is None or len(data) < min_size:
+            return
+        resp.text = None
+        loop = asyncio.get_event_loop()
+        resp.data = await loop.run_in_executor(None, compress, data, encoding)
+        resp.set_header("Content-Encoding", encoding)
@@ -0,0 +1,47 @@
+import re
+from urllib.parse import unquote, urlencode
+
+import falcon
+import falcon.testing
+import ujson as json
+
+from api import QueryResource, check_access, parse_dates, routes
+
+
+patterns = [(re.compile(re.sub(r"{(\w+)}", r"(?P<\1>[^/]+)", uri_template) + "$"), resource)
+            for (uri_template, resource) in routes]
+
+
+def find_resource(path):
+    for (pattern, resource) in patterns:
+        m = pattern.match(path)
+        if m:
+            return resource, {k: unquote(v) for (k, v) in m.groupdict().items()}
+    raise falcon.HTTPNotFound()
+
+def call(token, method, path, params=None, body=None):
+    """Answer an API request in this process, with the same access checks and
+    resource logic as api.py. QueryResources return their result as Python
+    objects without serialising it, the Arrow format as bytes. The other
+    resources are small and their JSON responses are decoded.
+
+    Raises falcon.HTTPError like the API would respond with it.
+    """
+    check_access(token, path, method)
+    resource, uri_params = find_resource(path)
+    params = dict(params or {}, token=token)
+    environ = falcon.testing.create_environ(path=path, query_string=urlencode(params), method=method, body=body or "")
+    req = falcon.Request(environ)
+    if method == "GET" and isinstance(resource, QueryResource):
+        start, end = parse_dates(req)
+        return resource.get(req, start, end, **uri_params)
+
+    responder = getattr(resource, "on_" + method.lower(), None)
+    if responder is None:
+        raise falcon.HTTPMethodNotAllowed([m for m in ["GET", "POST", "PUT", "PATCH", "DELETE"]
+                                           if hasattr(resource, "on_" + m.lower())])
+    resp = falcon.Response()
+    responder(req, resp, **uri_params)
+    if resp.data is not None:
+        return resp.data
+    return json.loads(resp.text) if resp.text else None
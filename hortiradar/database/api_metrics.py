@@ -0,0 +1,138 @@
+import asyncio
+import re
+from collections import defaultdict
+from time import perf_counter
+
+from redis import StrictRedis
+
+from hortiradar.clustering import Config
+
+
+redis = StrictRedis()
+
+metrics_key = "api:metrics"
+
+
+def get_buckets(option):
+    return [float(b) for b in Config.get("api:metrics", option).split(",")]
+
+# (name, description, upper bounds of the buckets)
+histograms = [
+    ("api_request_duration_seconds", "Time to answer the request in seconds.", get_buckets("duration_buckets")),
+    ("api_response_size_bytes", "Size of the response body in bytes as sent, after compression.", get_buckets("size_buckets")),
+    ("api_mongo_documents_returned", "Number of documents MongoDB returned for the request.", get_buckets("document_buckets")),
+]
+
+
+def route_patterns(routes):
+    """Regular expressions matching the paths of every URI template."""
+    return [(re.compile(re.sub(r"{\w+}", "[^/]+", uri_template) + "$"), uri_template) for (uri_template, _) in routes]
+
+def get_route(patterns, path):
+    for (pattern, uri_template) in patterns:
+        if pattern.match(path):
+            return uri_template
+    return "unmatched"          # don't use the path itself, it's unbounded
+
+def response_size(resp):
+    if resp.data is not None:
+        return len(resp.data)
+    return len(resp.text.encode("utf-8")) if resp.text else 0
+
+def record(route, method, status, observations):
+    """Count the request and add the observations {histogram name: value}.
+    The counts live in a Redis hash, so /metrics shows the totals of all
+    API processes. Buckets are stored non-cumulative and summed in `render`.
+    """
+    labels = "|".join([route, method, status])
+    pipe = redis.pipeline(transaction=False)
+    pipe.hincrby(metrics_key, "api_requests_total|" + labels, 1)
+    for (name, _, buckets) in histograms:
+        value = observations.get(name)
+        if value is None:
+            continue
+        le = next((b for b in buckets if value <= b), "+Inf")
+        pipe.hincrby(metrics_key, "{}_bucket|{}|{}".format(name, labels, le), 1)
+        pipe.hincrbyfloat(metrics_key, "{}_sum|{}".format(name, labels), value)
+        pipe.hincrby(metrics_key, "{}_count|{}".format(name, labels), 1)
+    pipe.execute()
+
+def format_labels(labels, le=None):
+    route, method, status = labels
+    s = 'route="{}",method="{}",status="{}"'.format(route, method, status)
+    if le is not None:
+        s += ',le="{}"'.format(le)
+    return "{" + s + "}"
+
+def format_bound(b):
+    return "+Inf" if b == "+Inf" else "{:g}".format(b)
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    stored = {k.decode("utf-8"): v.decode("utf-8") for (k, v) in redis.hgetall(metrics_key).items()}
+    values = defaultdict(dict)  # metric name -> {labels: value}
+    for (field, value) in stored.items():
+        name, *labels = field.split("|")
+        values[name][tuple(labels)] = value
+
+    lines = [
+        "# HELP api_requests_total Number of requests answered.",
+        "# TYPE api_requests_total counter"
+    ]
+    for (labels, value) in sorted(values["api_requests_total"].items()):
+        lines.append("api_requests_total{} {}".format(format_labels(labels), value))
+
+    for (name, description, buckets) in histograms:
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} histogram".format(name))
+        bucket_counts = values[name + "_bucket"]
+        for (labels, count) in sorted(values[name + "_count"].items()):
+            cumulative = 0
+            for b in buckets + ["+Inf"]:
+                cumulative += int(bucket_counts.get(labels + (str(b),), 0))
+                lines.append("{}_bucket{} {}".format(name, format_labels(labels, format_bound(b)), cumulative))
+            lines.append("{}_sum{} {}".format(name, format_labels(labels), values[name + "_sum"].get(labels, 0)))
+            lines.append("{}_count{} {}".format(name, format_labels(labels), count))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """Records per-route request counts, latencies, response sizes and the
+    number of documents returned by MongoDB (resources put it in
+    req.context.documents). Must be the first middleware, so the latency
+    covers the other middleware and the size is measured after compression.
+    """
+
+    def __init__(self, routes):
+        self.patterns = route_patterns(routes)
+
+    def process_request(self, req, resp):
+        req.context.metrics_start = perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        observations = {
+            "api_request_duration_seconds": perf_counter() - req.context.metrics_start,
+            "api_response_size_bytes": response_size(resp),
+            "api_mongo_documents_returned": getattr(req.context, "documents", None)
+        }
+        record(get_route(self.patterns, req.path), req.method, resp.status.split()[0], observations)
+
+
+class AsyncMetricsMiddleware:
+    """MetricsMiddleware for the ASGI app."""
+
+    def __init__(self, routes):
+        self.patterns = route_patterns(routes)
+
+    async def process_request(self, req, resp):
+        req.context.metrics_start = perf_counter()
+
+    async def process_response(self, req, resp, resource, req_succeeded):
+        observations = {
+            "api_request_duration_seconds": perf_counter() - req.context.metrics_start,
+            "api_response_size_bytes": response_size(resp),
+            "api_mongo_documents_returned": getattr(req.context, "documents", None)
+        }
+        status = str(resp.status).split()[0]
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, record, get_route(self.patterns, req.path), req.method, status, observations)
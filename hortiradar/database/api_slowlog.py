@@ -0,0 +1,110 @@
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from time import time
+
+import ujson as json
+from bson import json_util
+from redis import StrictRedis
+
+from keywords import get_db
+from hortiradar.clustering import Config
+
+
+redis = StrictRedis()
+tweets = get_db().tweets
+
+threshold = Config.getfloat("api:slowlog", "threshold")
+max_entries = Config.getint("api:slowlog", "max_entries")
+retention = Config.getint("api:slowlog", "retention")
+
+slowlog_key = "api:slowlog"
+
+# explain() runs the query again, so do it outside of the request
+executor = ThreadPoolExecutor(max_workers=1)
+
+
+def query_shape(query):
+    """The query with its values replaced by their types, so queries that only
+    differ in the keyword or dates are logged as one entry."""
+    if isinstance(query, dict):
+        return {k: query_shape(v) for (k, v) in query.items()}
+    elif isinstance(query, list):
+        return [query_shape(v) for v in query[:1]]
+    return type(query).__name__
+
+def plan_summary(plan):
+    """The stages of a winning plan from the top, e.g. "PROJECTION < FETCH < IXSCAN keywords_1_datetime_1"."""
+    stages = []
+    while plan:
+        stage = plan["stage"]
+        if "indexName" in plan:
+            stage += " " + plan["indexName"]
+        stages.append(stage)
+        if "inputStages" in plan:
+            stages.append("(" + ", ".join(plan_summary(p) for p in plan["inputStages"]) + ")")
+            break
+        plan = plan.get("inputStage")
+    return " < ".join(stages)
+
+def explain(query, projection):
+    result = tweets.find(query, projection=projection).explain()
+    stats = result.get("executionStats", {})
+    return {
+        "plan": plan_summary(result["queryPlanner"]["winningPlan"]),
+        "keys_examined": stats.get("totalKeysExamined", -1),
+        "docs_examined": stats.get("totalDocsExamined", -1),
+        "returned": stats.get("nReturned", -1),
+        "execution_ms": stats.get("executionTimeMillis", -1)
+    }
+
+def log_query(resource, query, projection, duration):
+    """Record a tweets.find of the resource that took longer than `threshold` seconds."""
+    if duration >= threshold:
+        executor.submit(record, resource, query, projection, duration)
+
+def record(resource, query, projection, duration):
+    """Counts the slow query under its shape. A query slower than the worst
+    one seen for its shape replaces it, together with its explain() summary."""
+    shape = md5(json_util.dumps([resource, query_shape(query)], sort_keys=True).encode("utf-8")).hexdigest()
+    entry_key = "{}:{}".format(slowlog_key, shape)
+    worst = redis.zscore(slowlog_key, shape)
+
+    pipe = redis.pipeline()
+    pipe.hincrby(entry_key, "count", 1)
+    pipe.hset(entry_key, "last_seen", int(time()))
+    if worst is None or duration > worst:
+        entry = {
+            "resource": resource,
+            "query": json_util.dumps(query),
+            "projection": json_util.dumps(projection),
+            "duration": duration
+        }
+        entry.update(explain(query, projection))
+        pipe.zadd(slowlog_key, {shape: duration})
+        pipe.hmset(entry_key, entry)
+    pipe.expire(entry_key, retention)
+    pipe.expire(slowlog_key, retention)
+    # keep only the worst max_entries shapes
+    pipe.zremrangebyrank(slowlog_key, 0, -max_entries - 1)
+    pipe.execute()
+
+def worst_queries(n):
+    """The n slowest query shapes, slowest first. The query and projection are
+    in MongoDB extended JSON, so dates show as {"$date": ...}."""
+    entries = []
+    for shape in redis.zrevrange(slowlog_key, 0, n - 1):
+        stored = redis.hgetall("{}:{}".format(slowlog_key, shape.decode("utf-8")))
+        if not stored or b"query" not in stored:
+            continue            # expired
+        entry = {k.decode("utf-8"): v.decode("utf-8") for (k, v) in stored.items()}
+        for k in ["query", "projection"]:
+            entry[k] = json.loads(entry[k])
+        for k in ["count", "last_seen", "keys_examined", "docs_examined", "returned", "execution_ms"]:
+            entry[k] = int(entry[k])
+        entry["duration"] = float(entry["duration"])
+        entries.append(entry)
+    return entries
+
+def clear():
+    shapes = redis.zrange(slowlog_key, 0, -1)
+    redis.delete(slowlog_key, *["{}:{}".format(slowlog_key, s.decode("utf-8")) for s in shapes])
@@ -0,0 +1,126 @@
+from collections import defaultdict
+from datetime import datetime
+from time import sleep, time
+
+from bson import json_util
+from pymongo.errors import OperationFailure, PyMongoError
+
+from invalidation import invalidate, tweet_tags
+from keywords import get_db
+from rollups import floor_hour, get_time, ingest_lag, mark_dirty, redis, roll_up_dirty, until_key
+from hortiradar.clustering import Config
+
+
+db = get_db()
+
+flush_interval = Config.getint("changes", "flush_interval")
+rollup_interval = Config.getint("changes", "rollup_interval")
+
+token_key = "changes:resume_token"
+
+# only the fields the invalidation needs, the change events don't carry whole tweets
+pipeline = [
+    {"$match": {
+        "ns.coll": {"$in": ["tweets", "groups", "stories", "news"]},
+        "operationType": {"$in": ["insert", "update", "replace", "delete"]}
+    }},
+    {"$project": {
+        "ns": True, "operationType": True,
+        "fullDocument.keywords": True, "fullDocument.datetime": True,
+        "fullDocument.groups": True, "fullDocument.pubdate": True
+    }}
+]
+
+
+class Changes:
+    """The invalidations and dirty rollups collected from change events."""
+
+    def __init__(self):
+        self.hours = defaultdict(set)   # invalidation tag -> hours (None for all)
+        self.tweets = []
+
+    def add(self, change):
+        coll = change["ns"]["coll"]
+        doc = change.get("fullDocument")
+        if coll == "groups":
+            self.hours["groups"].add(None)
+            return
+        # delete events have no document, the API invalidates the tweets it deletes
+        if doc is None:
+            return
+        if coll == "tweets":
+            if "datetime" not in doc:
+                return
+            # new tweets are in open windows, only late ones change closed windows
+            if change["operationType"] == "insert" and doc["datetime"] > datetime.utcnow() - ingest_lag:
+                return
+            for tag in tweet_tags(doc):
+                self.hours[tag].add(floor_hour(doc["datetime"]))
+            self.tweets.append(doc)
+        elif coll == "stories" and "datetime" in doc:
+            for group in doc.get("groups", []):
+                self.hours["stories:" + group].add(floor_hour(doc["datetime"]))
+        elif coll == "news" and "pubdate" in doc:
+            for kw in doc.get("keywords", []):
+                self.hours["news:" + kw].add(floor_hour(doc["pubdate"]))
+
+    def flush(self):
+        deleted = 0
+        for (tag, hours) in self.hours.items():
+            deleted += invalidate(tag, None if None in hours else hours)
+        mark_dirty(self.tweets)
+        self.hours.clear()
+        self.tweets = []
+        return deleted
+
+
+def load_token():
+    token = redis.get(token_key)
+    return json_util.loads(token) if token else None
+
+def save_token(token):
+    if token is not None:
+        redis.set(token_key, json_util.dumps(token))
+
+def watch():
+    """Follow the change stream of the database from the last resume token. Every
+    `flush_interval` seconds the cache entries with changed data are deleted,
+    every `rollup_interval` seconds the dirty rollups are recomputed."""
+    changes = Changes()
+    flushed = rolled_up = time()
+    with db.watch(pipeline, full_document="updateLookup", resume_after=load_token(),
+                  max_await_time_ms=1000) as stream:
+        while stream.alive:
+            change = stream.try_next()
+            if change is not None:
+                changes.add(change)
+            now = time()
+            if now - flushed >= flush_interval:
+                deleted = changes.flush()
+                if deleted:
+                    print("Invalidated {} cache entries".format(deleted))
+                # the changes are handled up to here, resume after them
+                save_token(stream.resume_token)
+                flushed = now
+            if now - rolled_up >= rollup_interval:
+                until = get_time(until_key)
+                if until:
+                    roll_up_dirty(until)
+                rolled_up = now
+
+
+def main():
+    while True:
+        try:
+            watch()
+        except OperationFailure as e:
+            # e.g. the resume token fell off the oplog, start from now
+            print("Change stream failed: {}".format(e))
+            redis.delete(token_key)
+        except PyMongoError as e:
+            print("Change stream failed: {}".format(e))
+            sleep(10)
+
+
+if __name__ == "__main__":
+    main()
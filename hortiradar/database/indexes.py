@@ -4,10 +4,18 @@ db = get_db()
 
 tweets = db.tweets
 stories = db.stories
+rollups = db.rollups
 
 tweets.create_index([("num_keywords", 1), ("datetime", 1)])  # api:/keywords, statistics.py
 tweets.create_index([("groups", 1), ("datetime", 1)])        # api:/keywords, api:/groups/{group}
 tweets.create_index([("keywords", 1), ("datetime", 1)])      # api:/keywords/{keyword}/*
+# keywords is an array, so no multikey index can cover /keywords/{keyword}/ids;
+# the spam filter runs on the fetched documents. Drop the wider index of before.
+if "keywords_1_datetime_1_spam_1_tweet.id_str_1" in tweets.index_information():
+    tweets.drop_index("keywords_1_datetime_1_spam_1_tweet.id_str_1")
 tweets.create_index("tweet.id_str")                          # api:/tweet/{id_str}
 
 stories.create_index([("groups", 1), ("datetime", 1)])       # storify.py:load_stories
+
+rollups.create_index([("keyword", 1), ("hour", 1)], unique=True)  # rollups.py
+rollups.create_index("hour")                                     # rollups.py:roll_up_hour
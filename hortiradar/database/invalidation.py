@@ -0,0 +1,67 @@
+from calendar import timegm
+from collections import defaultdict
+from time import time
+
+import ujson as json
+from redis import StrictRedis
+
+
+redis = StrictRedis()
+
+# incremented when API cache entries are invalidated, so the API processes drop their local copies
+generation_key = "cache:generation"
+
+
+def timestamp(dt):
+    return timegm(dt.utctimetuple())
+
+def deps_key(tag):
+    return "deps:" + tag
+
+def register(key, tags, start, end, cache_time):
+    """Remember that the cache entry `key` holds data of the tags (e.g.
+    "keyword:appel") from start to end, both datetimes or None for all time.
+    The registration expires with the entry."""
+    expires = time() + cache_time
+    member = json.dumps([key, timestamp(start) if start else 0, timestamp(end) if end else 0])
+    pipe = redis.pipeline()
+    for tag in tags:
+        pipe.zadd(deps_key(tag), {member: expires})
+        pipe.expire(deps_key(tag), cache_time)
+    pipe.execute()
+
+def invalidate(tag, hours=None):
+    """Delete the cache entries of the tag with data of the hours (datetimes),
+    or all of them. Returns the number of deleted entries."""
+    k = deps_key(tag)
+    redis.zremrangebyscore(k, 0, time())
+    stale = []
+    for member in redis.zrange(k, 0, -1):
+        key, start, end = json.loads(member)
+        if hours is None or any(start < timestamp(h) + 3600 and (not end or timestamp(h) < end) for h in hours):
+            stale.append((member, key))
+    if not stale:
+        return 0
+    pipe = redis.pipeline()
+    pipe.zrem(k, *[member for (member, _) in stale])
+    pipe.delete(*[key for (_, key) in stale])
+    if any(key.startswith("api:") for (_, key) in stale):
+        pipe.incr(generation_key)
+    pipe.execute()
+    return len(stale)
+
+def tweet_tags(doc):
+    """The tags of the cache entries with data of the tweet document."""
+    return ["keyword:" + kw for kw in doc.get("keywords", [])] + ["keywords"]
+
+def invalidate_tweets(tw):
+    """Delete the cache entries with data of the tweets, e.g. after deleting
+    them. Takes documents with the keywords and datetime fields."""
+    hours = defaultdict(set)
+    for t in tw:
+        for tag in tweet_tags(t):
+            hours[tag].add(t["datetime"].replace(minute=0, second=0, microsecond=0))
+    return sum(invalidate(tag, h) for (tag, h) in hours.items())
+
+def generation():
+    return int(redis.get(generation_key) or 0)
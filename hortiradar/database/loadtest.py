@@ -0,0 +1,142 @@
+import argparse
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from random import choice
+from threading import Thread
+from time import sleep, time
+
+import requests
+import ujson as json
+
+from hortiradar import time_format
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def get_params(days):
+    end = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    start = end - timedelta(days=days)
+    return {"start": start.strftime(time_format), "end": end.strftime(time_format)}
+
+def website_request(session, base_url, token, keywords):
+    """The website's processor: all tweets of a keyword of the past week."""
+    params = get_params(7)
+    params["token"] = token
+    return session.get("{}/keywords/{}".format(base_url, choice(keywords)), params=params)
+
+def external_request(session, base_url, token, keywords):
+    """External users: derived data of a keyword of the past day."""
+    params = get_params(1)
+    params["token"] = token
+    resource = choice(["series", "wordcloud", "users", "ids"])
+    if resource == "series":
+        params["step"] = 3600
+    return session.get("{}/keywords/{}/{}".format(base_url, choice(keywords), resource), params=params)
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    k = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+def compare_encodings(base_url, token, keyword):
+    """Fetches a week of the keyword with every content coding and prints the
+    bytes on the wire and the end-to-end time including decoding."""
+    params = get_params(7)
+    params["token"] = token
+    url = "{}/keywords/{}".format(base_url, keyword)
+    print("{:<10} {:>14} {:>14} {:>10}".format("encoding", "wire bytes", "body bytes", "time (ms)"))
+    for encoding in ["identity", "gzip", "zstd"] if zstandard else ["identity", "gzip"]:
+        t = time()
+        r = requests.get(url, params=params, headers={"Accept-Encoding": encoding}, stream=True)
+        wire = r.raw.read(decode_content=False)
+        content_encoding = r.headers.get("Content-Encoding", "identity")
+        body = decode(wire, content_encoding)
+        json.loads(body)
+        elapsed = time() - t
+        print("{:<10} {:>14,} {:>14,} {:>10.0f}".format(content_encoding, len(wire), len(body), elapsed * 1000))
+
+def decode(data, encoding):
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    elif encoding == "zstd":
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+def run_clients(request, num_clients, duration, *args):
+    """Runs num_clients clients sending requests for duration seconds. Returns
+    the latencies of successful requests and the number of failed requests."""
+    latencies = []
+    errors = [0]
+    stop = time() + duration
+
+    def client():
+        session = requests.Session()
+        while time() < stop:
+            t = time()
+            try:
+                r = request(session, *args)
+                ok = r.status_code == 200
+            except requests.RequestException:
+                ok = False
+            if ok:
+                latencies.append(time() - t)
+            else:
+                errors[0] += 1
+                sleep(0.1)
+
+    with ThreadPoolExecutor(max_workers=num_clients) as executor:
+        for _ in range(num_clients):
+            executor.submit(client)
+    return latencies, errors[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the API with concurrent website and external user traffic.")
+    parser.add_argument("--url", default="http://127.0.0.1:8888")
+    parser.add_argument("--admin-token", required=True, help="token for the website traffic")
+    parser.add_argument("--user-token", help="token for the external user traffic")
+    parser.add_argument("--website-clients", type=int, default=4)
+    parser.add_argument("--external-clients", type=int, default=16)
+    parser.add_argument("--duration", type=int, default=60, help="seconds")
+    parser.add_argument("--encodings", action="store_true",
+                        help="compare response sizes and times of the content codings instead")
+    parser.add_argument("keywords", nargs="+")
+    args = parser.parse_args()
+
+    if args.encodings:
+        for keyword in args.keywords:
+            print(keyword)
+            compare_encodings(args.url, args.admin_token, keyword)
+        return
+    if not args.user_token:
+        parser.error("the load test needs --user-token")
+
+    results = {}
+
+    def run(name, request, num_clients, token):
+        results[name] = run_clients(request, num_clients, args.duration, args.url, token, args.keywords)
+
+    threads = [
+        Thread(target=run, args=("website", website_request, args.website_clients, args.admin_token)),
+        Thread(target=run, args=("external", external_request, args.external_clients, args.user_token)),
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print("{:<10} {:>8} {:>8} {:>10} {:>10}".format("traffic", "requests", "errors", "p50 (ms)", "p99 (ms)"))
+    for name in ["website", "external"]:
+        latencies, errors = results[name]
+        print("{:<10} {:>8} {:>8} {:>10.0f} {:>10.0f}".format(
+            name, len(latencies), errors, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+
+
+if __name__ == "__main__":
+    main()
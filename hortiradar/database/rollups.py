@@ -0,0 +1,163 @@
+import argparse
+from collections import Counter, defaultdict
+from calendar import timegm
+from datetime import datetime, timedelta
+
+from bson import Binary
+from pymongo import UpdateOne
+from redis import StrictRedis
+
+from keywords import get_db
+from sketches import HyperLogLog, top_k
+from hortiradar import time_format
+from hortiradar.clustering import Config
+from hortiradar.database import stop_words
+
+
+db = get_db()
+tweets = db.tweets
+rollups = db.rollups
+redis = StrictRedis()
+
+spam_level = Config.getfloat("database:parameters", "spam_level")
+ingest_lag = timedelta(seconds=Config.getint("api:cache", "ingest_lag"))
+user_counters = Config.getint("rollups", "user_counters")
+word_counters = Config.getint("rollups", "word_counters")
+hll_precision = Config.getint("rollups", "hll_precision")
+
+since_key = "rollups:since"     # start of the first rolled up hour
+until_key = "rollups:until"     # end of the last rolled up hour
+dirty_key = "rollups:dirty"     # "keyword|hour" of rollups to recompute
+
+one_hour = timedelta(hours=1)
+
+
+def floor_hour(dt):
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+def ceil_hour(dt):
+    hour = floor_hour(dt)
+    return hour if hour == dt else hour + one_hour
+
+def get_time(key):
+    t = redis.get(key)
+    return datetime.utcfromtimestamp(int(t)) if t else None
+
+def set_time(key, dt):
+    redis.set(key, timegm(dt.utctimetuple()))
+
+def rolled_up_hours(start, end):
+    """The whole hours within [start, end) that have rollups, as (start, end), or None."""
+    since, until = get_time(since_key), get_time(until_key)
+    if since is None or until is None:
+        return None
+    s = max(ceil_hour(start), since)
+    e = min(floor_hour(end), until)
+    return (s, e) if s < e else None
+
+def get_rollups(keywords, start, end, field):
+    query = {"keyword": {"$in": keywords}, "hour": {"$gte": start, "$lt": end}}
+    return rollups.find(query, projection={"keyword": True, field: True, "_id": False})
+
+
+def users_rollup(counts):
+    """Summary of the number of tweets per user in an hour: the top `user_counters`
+    users as a Misra-Gries summary, and a HyperLogLog of all users if there are
+    more, otherwise the counts are exact and contain every user."""
+    summary, decrement = top_k(counts, user_counters)
+    rollup = {"tweets": sum(counts.values()), "counts": list(summary.items()), "decrement": decrement}
+    if len(counts) > user_counters:
+        hll = HyperLogLog(hll_precision)
+        hll.update(counts)
+        rollup["hll"] = Binary(hll.to_bytes())
+    return rollup
+
+def words_rollup(counts):
+    """The lemma counts of an hour pruned to a Misra-Gries summary of the top
+    `word_counters` lemmas: every count is at most `decrement` too low."""
+    summary, decrement = top_k(counts, word_counters)
+    return {"tokens": sum(counts.values()), "counts": list(summary.items()), "decrement": decrement}
+
+def roll_up_hour(hour, keywords=None):
+    """(Re)compute the rollups of the hour for the keywords, or for all keywords."""
+    query = {
+        "datetime": {"$gte": hour, "$lt": hour + one_hour},
+        "spam": {"$not": {"$gt": spam_level}}
+    }
+    if keywords:
+        query["keywords"] = {"$in": list(keywords)}
+    else:
+        query["num_keywords"] = {"$gt": 0}
+    users = defaultdict(Counter)
+    words = defaultdict(Counter)
+    projection = {"keywords": True, "tweet.user.id_str": True, "tokens.lemma": True, "_id": False}
+    for t in tweets.find(query, projection=projection):
+        lemmas = [token["lemma"] for token in t["tokens"] if token["lemma"].lower() not in stop_words]
+        for kw in t["keywords"]:
+            users[kw][t["tweet"]["user"]["id_str"]] += 1
+            words[kw].update(lemmas)
+
+    if keywords:
+        found = keywords
+    else:
+        found = list(users)
+        rollups.delete_many({"hour": hour, "keyword": {"$nin": found}})
+    updates = [
+        UpdateOne({"keyword": kw, "hour": hour}, {"$set": {
+            "users": users_rollup(users.get(kw, Counter())),
+            "words": words_rollup(words.get(kw, Counter()))
+        }}, upsert=True)
+        for kw in found
+    ]
+    if updates:
+        rollups.bulk_write(updates, ordered=False)
+
+def mark_dirty(tw):
+    """Mark the rollups of the tweets for recomputation, e.g. after their spam
+    score changed. Takes documents with the keywords and datetime fields."""
+    members = set()
+    for t in tw:
+        hour = timegm(floor_hour(t["datetime"]).utctimetuple())
+        members.update("{}|{}".format(kw, hour) for kw in t.get("keywords", []))
+    if members:
+        redis.sadd(dirty_key, *members)
+
+def roll_up_dirty(until):
+    pipe = redis.pipeline()
+    pipe.smembers(dirty_key)
+    pipe.delete(dirty_key)
+    members, _ = pipe.execute()
+    hours = defaultdict(set)
+    for m in members:
+        kw, hour = m.decode("utf-8").rsplit("|", 1)
+        hour = datetime.utcfromtimestamp(int(hour))
+        if hour < until:        # later hours are rolled up when they close
+            hours[hour].add(kw)
+    for (hour, keywords) in sorted(hours.items()):
+        roll_up_hour(hour, keywords)
+    return len(hours)
+
+def roll_up(since=None):
+    """Roll up the hours that closed since the last run, or since `since`, and
+    recompute the dirty rollups."""
+    end = floor_hour(datetime.utcnow() - ingest_lag)
+    hour = since or get_time(until_key) or end - one_hour
+    if since or get_time(since_key) is None:
+        set_time(since_key, hour)
+    while hour < end:
+        roll_up_hour(hour)
+        hour += one_hour
+        set_time(until_key, hour)
+    return roll_up_dirty(end)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Roll up the closed hours of tweets per keyword.")
+    parser.add_argument("--since", help="backfill from this hour, format: %s" % time_format.replace("%", "%%"))
+    args = parser.parse_args()
+    since = floor_hour(datetime.strptime(args.since, time_format)) if args.since else None
+    roll_up(since)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+from collections import Counter
+from hashlib import sha1
+from math import log
+
+
+def top_k(counts, k):
+    """Misra-Gries summary of at most k counters from exact counts. Every counter
+    is decreased by the (k+1)th largest count, so a count estimated from the
+    summary is at most `decrement` below the true count. Returns (counts, decrement).
+    """
+    if len(counts) <= k:
+        return dict(counts), 0
+    ranked = Counter(counts).most_common(k + 1)
+    decrement = ranked[k][1]
+    return {key: c - decrement for (key, c) in ranked[:k] if c > decrement}, decrement
+
+def merge_top_k(summaries, k):
+    """Merge Misra-Gries summaries [(counts, decrement), ...] into one of at most
+    k counters. The decrements add up, as do the error bounds."""
+    counts = Counter()
+    decrement = 0
+    for (c, d) in summaries:
+        counts.update(c)
+        decrement += d
+    summary, d = top_k(counts, k)
+    return summary, decrement + d
+
+
+class HyperLogLog:
+    """Distinct count estimate in 2^p one-byte registers, the standard error is
+    about 1.04 / sqrt(2^p). Sketches of the same p merge by taking the maximum of
+    each register, so the distinct count of a window is the merge of its hours.
+    """
+
+    def __init__(self, p=11, registers=None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+
+    def add(self, value):
+        x = int.from_bytes(sha1(value.encode("utf-8")).digest()[:8], "big")
+        index = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for v in values:
+            self.add(v)
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * log(self.m / zeros)  # linear counting for small counts
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return bytes(self.registers)
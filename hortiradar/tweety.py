@@ -1,14 +1,35 @@
+from collections import OrderedDict
+
 import requests
 
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# urllib3 only decodes zstd when the zstandard package is installed
+try:
+    from urllib3.response import ZstdDecoder  # noqa: F401
+    accept_encoding = "zstd, gzip"
+except ImportError:
+    accept_encoding = "gzip"
+
 
 time_format = "%Y-%m-%dT%H:%M:%S"
 
 
 class Tweety:
-    def __init__(self, base_url, token):
+    def __init__(self, base_url, token, cache_bytes=32 * 1024 * 1024):
         self.base_url = base_url
         self.token = token
         self.s = requests.Session()
+        # requests decodes the compressed responses transparently
+        self.s.headers["Accept-Encoding"] = accept_encoding
+        # responses to GET requests with their validators, for conditional requests,
+        # at most cache_bytes of response bodies
+        self.cache_bytes = cache_bytes
+        self.cached_bytes = 0
+        self.responses = OrderedDict()
 
         def wrap_api(method, uri_template, name=None):
             request = eval("self.s." + method)
@@ -17,6 +38,8 @@ class Tweety:
                 url = self.base_url + uri_template.format(*uri_params)
                 params["token"] = self.token
                 data = params.pop("data", None)
+                if method == "get":
+                    return self.conditional_get(url, params, data)
                 r = request(url, params=params, data=data)
                 # TODO: raise exception if request is unsuccessful
                 if r.content:
@@ -35,9 +58,13 @@ class Tweety:
         self.get_keyword_urls = wrap_api("get", "/keywords/{}/urls", name="get_keyword_urls")
         self.get_keyword_texts = wrap_api("get", "/keywords/{}/texts", name="get_keyword_texts")
         self.get_keyword_users = wrap_api("get", "/keywords/{}/users", name="get_keyword_users")
+        self.get_keyword_user_count = wrap_api("get", "/keywords/{}/users/count", name="get_keyword_user_count")
         self.get_keyword_wordcloud = wrap_api("get", "/keywords/{}/wordcloud", name="get_keyword_wordcloud")
         # tweety.get_keyword_series("meloen", step=3600)
         self.get_keyword_series = wrap_api("get", "/keywords/{}/series", name="get_keyword_series")
+        # tweety.get_series(keywords="meloen,appel", step=3600), without keywords for all keywords
+        self.get_series = wrap_api("get", "/series", name="get_series")
+        self.get_wordclouds = wrap_api("get", "/wordclouds", name="get_wordclouds")
         self.get_groups = wrap_api("get", "/groups", name="get_groups")
         self.post_groups = wrap_api("post", "/groups", name="post_groups")
         self.get_group = wrap_api("get", "/groups/{}", name="get_group")
@@ -47,3 +74,86 @@ class Tweety:
         self.delete_tweet = wrap_api("delete", "/tweet/{}", name="delete_tweet")
         #  tweety.patch_tweet(id_str, data=json.dumps({"spam": 1.0}))
         self.patch_tweet = wrap_api("patch", "/tweet/{}", name="patch_tweet")
+        # tweety.get_tweets(ids=",".join(ids))
+        self.get_tweets = wrap_api("get", "/tweets", name="get_tweets")
+        # tweety.patch_tweets(data=json.dumps({"ids": ids, "patch": {"spam": 1.0}}))
+        self.patch_tweets = wrap_api("patch", "/tweets", name="patch_tweets")
+        # tweety.delete_tweets(data=json.dumps({"ids": ids}))
+        self.delete_tweets = wrap_api("delete", "/tweets", name="delete_tweets")
+
+    def conditional_get(self, url, params, data=None):
+        """GET request that revalidates a previous response with the ETag and
+        Last-Modified validators, so unchanged data isn't sent again. Raises
+        requests.HTTPError if the request is unsuccessful."""
+        key = (url, tuple(sorted((k, str(v)) for (k, v) in params.items())), str(data))
+        cached = self.responses.get(key)
+        headers = {}
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        r = self.s.get(url, params=params, data=data, headers=headers)
+        if r.status_code == 304 and cached:
+            self.responses.move_to_end(key)
+            return cached[2]
+        r.raise_for_status()
+        etag = r.headers.get("ETag")
+        last_modified = r.headers.get("Last-Modified")
+        if r.status_code == 200 and (etag or last_modified):
+            self.store(key, (etag, last_modified, r.content))
+        if r.content:
+            return r.content
+        else:
+            return r.status_code
+
+    def store(self, key, response):
+        """Keep the response, dropping the least recently used ones beyond cache_bytes."""
+        old = self.responses.pop(key, None)
+        if old:
+            self.cached_bytes -= len(old[2])
+        if len(response[2]) > self.cache_bytes:
+            return
+        self.responses[key] = response
+        self.cached_bytes += len(response[2])
+        while self.cached_bytes > self.cache_bytes:
+            _, (_, _, body) = self.responses.popitem(last=False)
+            self.cached_bytes -= len(body)
+
+    def get_keyword_arrays(self, keyword, **params):
+        """The tweets of keyword from the columnar Arrow format of /keywords/{keyword}
+        as NumPy arrays, see keyword_arrays."""
+        url = self.base_url + "/keywords/{}".format(keyword)
+        params["token"] = self.token
+        params["format"] = "arrow"
+        r = self.s.get(url, params=params)
+        r.raise_for_status()
+        return keyword_arrays(r.content)
+
+
+def keyword_arrays(data):
+    """The Arrow IPC stream of /keywords/{keyword} as NumPy arrays. Returns a
+    dict with the arrays:
+        - id, created_at (seconds since epoch), user_id, retweet_id,
+          retweet_user_id, retweet_count: one int64 per tweet, 0 for no retweet
+        - lemmas, pos: the token indices of all tweets after each other
+        - lemmas_offsets, pos_offsets: tweet i has the tokens
+          lemmas[lemmas_offsets[i]:lemmas_offsets[i + 1]]
+        - lemmas_vocabulary, pos_vocabulary: the strings of the token indices
+    """
+    if pyarrow is None:
+        raise ImportError("keyword_arrays requires pyarrow")
+    table = pyarrow.ipc.open_stream(data).read_all()
+
+    arrays = {}
+    for name in ["id", "created_at", "user_id", "retweet_id", "retweet_user_id", "retweet_count"]:
+        arrays[name] = table.column(name).to_numpy()
+    for name in ["lemmas", "pos"]:
+        column = table.column(name)
+        column = column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+        tokens = column.values
+        arrays[name] = tokens.indices.to_numpy(zero_copy_only=False)
+        arrays[name + "_offsets"] = column.offsets.to_numpy()
+        arrays[name + "_vocabulary"] = tokens.dictionary.to_numpy(zero_copy_only=False)
+    return arrays
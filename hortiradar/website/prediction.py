@@ -8,13 +8,15 @@ from redis import StrictRedis
 from scipy.interpolate import interp1d
 from statsmodels.tsa.seasonal import seasonal_decompose
 
-from hortiradar import TOKEN, Tweety, time_format
+from hortiradar import TOKEN, time_format
+from hortiradar.client import LocalTweety, TweetyServerError
 from hortiradar.database import get_keywords
 from hortiradar.clustering.util import round_time
 
 
 wikipedia.set_lang("nl")
-tweety = Tweety("http://127.0.0.1:8888", TOKEN)
+# runs on the API server: query the database in-process instead of over HTTP
+tweety = LocalTweety(TOKEN)
 keywords = get_keywords(local=True)
 redis = StrictRedis()
 
@@ -67,36 +69,42 @@ class Redistributor:
         return red_data
 
 
-def get_wordcloud(kw, s):
-    jstr = tweety.get_keyword_wordcloud(kw, start=datetime.strftime(s-timedelta(hours=1), time_format), end=datetime.strftime(s, time_format)).decode("utf-8")
-    tokens = json.loads(jstr)
-    terms = []
-    for token in tokens:
-        term = {"size": token["count"], "name": token["word"]}
-        try:
-            page = wikipedia.page(token["word"])
-            term["summary"] = page.summary
-        except Exception:
-            term["summary"] = ""
-
-        terms.append(term)
+def get_wordclouds(kws, s):
+    """Word clouds of the keywords in the hour before s, in one request."""
+    wordclouds = tweety.get_wordclouds(keywords=",".join(kws), start=datetime.strftime(s-timedelta(hours=1), time_format), end=datetime.strftime(s, time_format))
+    terms = {}
+    for kw in kws:
+        terms[kw] = []
+        for token in wordclouds.get(kw, []):
+            term = {"size": token["count"], "name": token["word"]}
+            try:
+                page = wikipedia.page(token["word"])
+                term["summary"] = page.summary
+            except Exception:
+                term["summary"] = ""
+
+            terms[kw].append(term)
     return terms
 
 
-def get_ts(kw, s, e):
-    jstr = tweety.get_keyword_series(kw, step=3600, start=datetime.strftime(s, time_format), end=datetime.strftime(e, time_format)).decode("utf-8")
-    if "Internal Server Error" not in jstr:
-        res = json.loads(jstr)
-        nh = num_hours(datetime.strptime(res["end"], time_format) - datetime.strptime(res["start"], time_format))
-        ts = np.transpose([res["series"][str(k)] if str(k) in res["series"] else 0 for k in range(nh)])
-        ans_s = datetime.strptime(res["start"], time_format)
-        ans_e = datetime.strptime(res["end"], time_format)
-        if ans_s != s:
-            ts = np.append(np.ones(num_hours(ans_s - s)), ts)
-        if ans_e != e:
-            ts = np.append(ts, np.ones(num_hours(e - ans_e)))
-    else:
-        ts = []
+def get_all_ts(s, e):
+    """Hourly time series of all keywords, in one request."""
+    try:
+        series = tweety.get_series(step=3600, start=datetime.strftime(s, time_format), end=datetime.strftime(e, time_format))
+    except TweetyServerError:
+        return {}
+    return {kw: to_ts(res, s, e) for (kw, res) in series.items()}
+
+
+def to_ts(res, s, e):
+    nh = num_hours(datetime.strptime(res["end"], time_format) - datetime.strptime(res["start"], time_format))
+    ts = np.transpose([res["series"][str(k)] if str(k) in res["series"] else 0 for k in range(nh)])
+    ans_s = datetime.strptime(res["start"], time_format)
+    ans_e = datetime.strptime(res["end"], time_format)
+    if ans_s != s:
+        ts = np.append(np.ones(num_hours(ans_s - s)), ts)
+    if ans_e != e:
+        ts = np.append(ts, np.ones(num_hours(e - ans_e)))
     return ts
 
 
@@ -104,7 +112,7 @@ def num_hours(td):
     return 24*td.days + td.seconds//3600
 
 
-def check_for_peak(kw, now, begin):
+def check_for_peak(kw, now, begin, timeseries):
     s = round_time(begin, "day")
     e = round_time(now, "day", rounding="ceil")
 
@@ -112,8 +120,7 @@ def check_for_peak(kw, now, begin):
     df["hours"] = [s + timedelta(hours=x) for x in range(num_hours(e-s))]
     df.set_index("hours", inplace=True)
 
-    timeseries = get_ts(kw, s, now)
-    if timeseries != []:
+    if len(timeseries) > 0:
         missing_hours = num_hours(e-s) - len(timeseries)
         df[kw] = np.append(timeseries, [np.nan] * missing_hours)
 
@@ -176,19 +183,16 @@ def main():
     peak_df["hours"] = [s + timedelta(hours=x) for x in range(num_hours(e-s))]
     peak_df.set_index("hours", inplace=True)
     peaks = []
-    terms = {}
 
+    all_ts = get_all_ts(s, end)
     for kw in keywords:
-        try:
-            df_kw, peak = check_for_peak(kw, end, start)
-            if peak:
-                peaks.append(kw)
-                peak_df = pd.concat([peak_df, df_kw], axis=1)
-                terms[kw] = get_wordcloud(kw, end)
-        except json.JSONDecodeError:
-            pass
+        df_kw, peak = check_for_peak(kw, end, start, all_ts.get(kw, []))
+        if peak:
+            peaks.append(kw)
+            peak_df = pd.concat([peak_df, df_kw], axis=1)
 
     if peaks:
+        terms = get_wordclouds(peaks, end)
         peaks_json = output_peaks(peaks, peak_df, terms)
     else:
         peaks_json = []
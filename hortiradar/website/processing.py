@@ -18,8 +18,10 @@ from redis import StrictRedis
 from pattern.nl import sentiment
 
 from hortiradar import Tweety, TOKEN, time_format
+from hortiradar.tweety import keyword_arrays
 from hortiradar.clustering import Token
 from hortiradar.database import stop_words, obscene_words, blacklist, get_db
+from hortiradar.database.invalidation import register
 from utils import floor_time
 
 db = get_db()
@@ -51,15 +53,52 @@ def get_cache_key(func, *args, **kwargs):
     )
     return json.dumps("cache:" + ":".join(k))
 
+def parse_time(t):
+    if t is None or isinstance(t, datetime):
+        return t
+    return datetime.strptime(t, time_format)
+
+def cache_dependencies(func, args, kwargs):
+    """The data a cached result depends on, as (tags, start, end), see
+    hortiradar.database.invalidation. The change stream consumer deletes the
+    result when that data changes."""
+    name = func.__name__
+    params = next((a for a in args if isinstance(a, dict)), kwargs)
+    start, end = parse_time(params.get("start")), parse_time(params.get("end"))
+    if name in ["get_keyword", "process_tokens"]:
+        tags = ["keyword:" + args[0]]
+    elif name == "process_details":
+        tags = ["keyword:" + args[0], "news:" + args[0]]
+    elif name in ["get_keywords", "process_top"]:
+        tags = ["keywords", "groups"]
+    elif name == "process_stories":
+        tags = ["stories:" + args[0]]
+    elif name == "process_news":
+        tags = ["news:" + args[0]]
+        start, end = parse_time(args[1]), parse_time(args[2])
+    elif name in ["get_groups", "get_group"]:
+        tags = ["groups"]
+    else:
+        tags = []
+    return tags, start, end
+
+def store(key, v, cache_time, func, args, kwargs):
+    redis.set(key, v, ex=cache_time)
+    tags, start, end = cache_dependencies(func, args, kwargs)
+    if tags:
+        register(key, tags, start, end, cache_time)
+
 # tweety methods return json string
 # internal app functions return python dicts/lists
-def cache(func, *args, cache_time=CACHE_TIME, force_refresh=False, path="", **kwargs):
+def cache(func, *args, cache_time=CACHE_TIME, force_refresh=False, path="", raw=False, **kwargs):
+    """The cached result of func. With raw, bytes results (e.g. the Arrow format)
+    are returned as they are instead of decoded from JSON."""
     loading_cache_time = 60 * 10
     key = get_cache_key(func, *args, **kwargs)
     v = redis.get(key)
 
     if v is not None and not force_refresh:
-        return json.loads(v) if type(v) == bytes else v
+        return json.loads(v) if type(v) == bytes and not raw else v
     else:
         loading_id = "loading:" + md5(key.encode("utf-8")).hexdigest()
         if not force_refresh:
@@ -72,24 +111,24 @@ def cache(func, *args, cache_time=CACHE_TIME, force_refresh=False, path="", **kw
             redis.set(loading_id, b"loading", ex=loading_cache_time)
             response = func(*args, force_refresh=force_refresh, cache_time=cache_time, **kwargs)
             v = json.dumps(response) if type(response) != bytes else response
-            redis.set(key, v, ex=cache_time)
+            store(key, v, cache_time, func, args, kwargs)
             redis.set(loading_id, b"done", ex=loading_cache_time)
-            return response if type(response) != bytes else json.loads(response)
+            return response if type(response) != bytes or raw else json.loads(response)
 
 @app.task
 def cache_request(func, args, kwargs, cache_time, key, loading_id):
     fun = cache_request.funs[func]
-    if fun in [process_top, process_details]:
+    if fun in [process_top, process_details, process_tokens]:
         kwargs["force_refresh"] = True
     response = fun(*args, cache_time=cache_time, **kwargs)
     v = json.dumps(response) if type(response) != bytes else response
-    redis.set(key, v, ex=cache_time)
+    store(key, v, cache_time, fun, args, kwargs)
     redis.set(loading_id, b"done", ex=cache_time)
 
 @app.task(name="tasks.mark_as_spam")
 def mark_as_spam(ids: Sequence[str]):
-    for id_str in ids:
-        tweety.patch_tweet(id_str, data=json.dumps({"spam": 0.8}))
+    if ids:
+        tweety.patch_tweets(data=json.dumps({"ids": list(ids), "patch": {"spam": 0.8}}))
 
 def get_nsfw_prob(image_url: str):
     cache_time = 12 * 60**2
@@ -123,8 +162,13 @@ def get_process_top_params(group):
     }
     return params
 
+def get_group_counts(params, force_refresh=False, cache_time=CACHE_TIME):
+    """The keyword counts of all groups with one request, cached together for all groups."""
+    params = {k: v for (k, v) in params.items() if k != "group"}
+    return cache(tweety.get_keywords, force_refresh=force_refresh, cache_time=cache_time, by_group=1, **params)
+
 def process_top(group, max_amount, params, force_refresh=False, cache_time=CACHE_TIME):
-    counts = cache(tweety.get_keywords, force_refresh=force_refresh, cache_time=cache_time, **params)
+    counts = get_group_counts(params, force_refresh=force_refresh, cache_time=cache_time).get(group, [])
     total = sum([entry["count"] for entry in counts])
 
     topkArray = []
@@ -138,20 +182,24 @@ def process_top(group, max_amount, params, force_refresh=False, cache_time=CACHE
     return topkArray
 
 def process_tokens(prod, params, force_refresh=False, cache_time=CACHE_TIME):
-    tweets = cache(tweety.get_keyword, prod, force_refresh=force_refresh, cache_time=CACHE_TIME, **params)
-
-    token_dict = Counter()
-
-    for i in range(len(tweets)):
-        tw = tweets[i]
-        tokens = [Token(t) for t in tw["tokens"]]
-
-        token_dict.update(tokens)
+    data = cache(tweety.get_keyword, prod, force_refresh=force_refresh, cache_time=CACHE_TIME, raw=True, format="arrow", **params)
+    tweets = keyword_arrays(data)
+    lemma_ids = tweets["lemmas"]
+    pos_ids = tweets["pos"]
+    lemmas = tweets["lemmas_vocabulary"]
+    pos = tweets["pos_vocabulary"]
+
+    # The lemma ids are numbered in order of first occurrence. Like a Counter
+    # of Tokens (which compare on lemma) a lemma keeps the pos of its first
+    # occurrence, and ties are ordered by first occurrence.
+    counts = np.bincount(lemma_ids, minlength=len(lemmas))
+    _, first = np.unique(lemma_ids, return_index=True)
 
     occurrences = []
-    for (token, count) in token_dict.most_common():
-        if not token.filter_token():
-            occurrences.append({"text": token.lemma, "pos": token.pos, "weight": count})
+    for i in np.argsort(-counts, kind="stable"):
+        token = Token.get(lemmas[i], pos[pos_ids[first[i]]])
+        if not token.filtered:
+            occurrences.append({"text": token.lemma, "pos": token.pos, "weight": int(counts[i])})
 
     data = {
         "occurrences": occurrences
@@ -1,12 +1,28 @@
 import argparse
+import asyncio
 from datetime import datetime
 
 import flask
 import ujson as json
 
 from app import app, get_period
-from hortiradar import time_format
-from processing import get_cache_key, get_process_top_params, process_details, process_top, redis
+from hortiradar import TOKEN, time_format
+from hortiradar.client import AsyncTweety
+from processing import (
+    get_cache_key, get_group_counts, get_process_top_params, process_details, process_top, redis, store, tweety)
+
+
+async def prefetch_keywords(keywords, params, cache_time):
+    """Fetch the tweets of all keywords concurrently into the cache that
+    process_details reads them from. Returns the keywords that failed."""
+    async with AsyncTweety("http://127.0.0.1:8888", TOKEN, pool_size=4, timeout=600) as client:
+        async def fetch(keyword):
+            data = await client.get_keyword(keyword, raw=True, **params)
+            store(get_cache_key(tweety.get_keyword, keyword, **params), data, cache_time,
+                  tweety.get_keyword, (keyword,), params)
+
+        results = await asyncio.gather(*[fetch(keyword) for keyword in keywords], return_exceptions=True)
+    return {kw for (kw, r) in zip(keywords, results) if isinstance(r, Exception)}
 
 
 def main():
@@ -23,26 +39,33 @@ def main():
     start_time = get_time()
     max_amount = 10
     group_data = []
+    # the counts of all groups with one request, process_top reads them from the cache
+    get_group_counts(get_process_top_params(groups[0]), force_refresh=True, cache_time=cache_time)
     for group in groups:
         if args.verbose:
             print("Caching group: {}".format(group))
         arguments = (group, max_amount, get_process_top_params(group))
         key = get_cache_key(process_top, *arguments)
-        data = process_top(*arguments, force_refresh=True, cache_time=cache_time)
+        data = process_top(*arguments, cache_time=cache_time)
         group_data.append((key, data))
-        redis.set(key, json.dumps(data), ex=cache_time)
+        store(key, json.dumps(data), cache_time, process_top, arguments, {})
 
     with app.test_request_context("/?period=week"):
         _, start, end, _ = get_period(flask.request, "week")
     params = {"start": start.strftime(time_format), "end": end.strftime(time_format)}
-    for (_, group) in group_data:
-        for keyword in group:
-            prod = keyword["label"]
-            if args.verbose:
-                print("Caching keyword: {}".format(prod))
-            key = get_cache_key(process_details, prod, params)
-            data = process_details(prod, params, force_refresh=True, cache_time=cache_time)
-            redis.set(key, json.dumps(data), ex=cache_time)
+    keywords = list(dict.fromkeys(keyword["label"] for (_, group) in group_data for keyword in group))
+    # results that the change stream consumer didn't invalidate are still up to date
+    keywords = [kw for kw in keywords if not redis.exists(get_cache_key(process_details, kw, params))]
+    if args.verbose:
+        print("Fetching {} keywords".format(len(keywords)))
+    failed = asyncio.run(prefetch_keywords(keywords, params, cache_time))
+    for prod in keywords:
+        if args.verbose:
+            print("Caching keyword: {}".format(prod))
+        key = get_cache_key(process_details, prod, params)
+        # the prefetched tweets are in the cache, only fetch the failed ones again
+        data = process_details(prod, params, force_refresh=prod in failed, cache_time=cache_time)
+        store(key, json.dumps(data), cache_time, process_details, (prod, params), {})
 
     end_time = get_time()
     sync_time = "{} - {}".format(start_time, end_time) if start_time != end_time else start_time
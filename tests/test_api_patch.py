@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+falcon = pytest.importorskip("falcon")
+testing = pytest.importorskip("falcon.testing")
+pytest.importorskip("pymongo")
+pytest.importorskip("redis")
+pytest.importorskip("ujson")
+
+# the API runs from hortiradar/database and imports its siblings as plain modules
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "hortiradar", "database"))
+keywords = pytest.importorskip("keywords")
+api_cache = pytest.importorskip("api_cache")
+
+
+@pytest.fixture(scope="module")
+def api():
+    # api loads the keywords from MongoDB and the cache generation from Redis at import time
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(keywords, "get_keywords", lambda local=False: {})
+        mp.setattr(api_cache, "generation", lambda: None)
+        import api
+    return api
+
+
+@pytest.mark.parametrize("patch", [["spam", 1.0], "spam", 1.0])
+def test_non_object_patch_is_bad_request(api, patch):
+    with pytest.raises(falcon.HTTPBadRequest):
+        api.json_merge_patch_to_mongo_update(patch)
+
+@pytest.mark.parametrize("patch", [["spam", 1.0], "spam"])
+def test_patch_tweets_non_object_patch_is_bad_request(api, patch):
+    body = api.json.dumps({"ids": ["1", "2"], "patch": patch})
+    req = testing.create_req(method="PATCH", path="/tweets", body=body, headers={"Content-Type": "application/json"})
+    with pytest.raises(falcon.HTTPBadRequest):
+        api.TweetsResource().on_patch(req, falcon.Response())
+
+def test_merge_patch_update(api):
+    update = api.json_merge_patch_to_mongo_update({"spam": 1.0, "groups": None})
+    assert update == {"$set": {"spam": 1.0}, "$unset": {"groups": True}}
@@ -0,0 +1,49 @@
+import random
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip("numpy")
+util = pytest.importorskip("hortiradar.clustering.util")
+tweet = pytest.importorskip("hortiradar.clustering.tweet")
+
+Token = tweet.Token
+
+
+def loop_best_tweet(tokens, filt_tokens, tweets, retweets):
+    """get_best_tweet before the sparse product: cos_sim per tweet."""
+    story_array = util.get_token_array(tokens, filt_tokens)
+    similarities = []
+    for tw in tweets:
+        sim_value = util.cos_sim(story_array, util.get_token_array(Counter(tw.tokens), filt_tokens))
+        if tw.tweet.id_str in retweets:
+            sim_value *= np.sqrt(len(retweets[tw.tweet.id_str]))
+        similarities.append(sim_value)
+    return tweets[np.argmax(similarities)]
+
+def make_tweet(id_str, lemmas):
+    return SimpleNamespace(tweet=SimpleNamespace(id_str=id_str), tokens=[Token.get(l, "N(soort)") for l in lemmas])
+
+
+def test_near_ties_like_loop():
+    # counts of 10^13 make the similarities differ only after the 12th decimal
+    a, b, c = (Token.get(l, "N(soort)") for l in ["appel", "peer", "kers"])
+    base = 10 ** 13
+    rng = random.Random(0)
+    for _ in range(200):
+        tokens = Counter({a: base + rng.randrange(3), b: base + rng.randrange(3), c: rng.randrange(1, 3)})
+        filt_tokens = [a, b, c]
+        tweets = [make_tweet(str(i), rng.choice([["appel"], ["peer"], ["appel", "kers"], ["peer", "kers"]]))
+                  for i in range(6)]
+        assert util.best_tweet(tokens, filt_tokens, tweets, {}) is loop_best_tweet(tokens, filt_tokens, tweets, {})
+
+def test_random_like_loop():
+    rng = random.Random(1)
+    lemmas = ["w%d" % i for i in range(30)]
+    for _ in range(200):
+        tweets = [make_tweet(str(i), rng.sample(lemmas, rng.randint(1, 6))) for i in range(rng.randint(1, 20))]
+        tokens = Counter(t for tw in tweets for t in tw.tokens)
+        filt_tokens = list(tokens)
+        retweets = {tw.tweet.id_str: [None] * rng.randint(1, 4) for tw in tweets if rng.random() < 0.3}
+        assert util.best_tweet(tokens, filt_tokens, tweets, retweets) is loop_best_tweet(tokens, filt_tokens, tweets, retweets)
@@ -0,0 +1,63 @@
+import types
+from collections import Counter
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+json = pytest.importorskip("ujson")
+pytest.importorskip("requests")
+
+from hortiradar import client  # noqa: E402
+
+
+# the result of api.time_series: the bins are a Counter with int keys
+SERIES = {
+    "appel": {
+        "start": "2017-06-01T00:00:00",
+        "end": "2017-06-01T03:00:00",
+        "step": 3600,
+        "bins": 2,
+        "series": Counter({0: 3, 2: 1})
+    }
+}
+
+
+class FakeApi:
+    """api_local with a fixed result for every call."""
+
+    falcon = types.SimpleNamespace(HTTPError=type("HTTPError", (Exception,), {}))
+
+    def __init__(self, result):
+        self.result = result
+
+    def call(self, token, method, path, params=None, body=None):
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+def local_tweety(monkeypatch, result):
+    monkeypatch.setattr(client, "load_api", lambda: FakeApi(result))
+    return client.LocalTweety("token")
+
+def http_tweety(result):
+    """TweetyClient answered by an API that serialises like api.py."""
+    tweety = client.TweetyClient("http://127.0.0.1:8888", "token", retries=0)
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, content=json.dumps(result)))
+    tweety.client = httpx.Client(transport=transport)
+    return tweety
+
+
+def test_local_series_equal_to_http(monkeypatch):
+    local = local_tweety(monkeypatch, SERIES).get_series(step=3600)
+    assert local == http_tweety(SERIES).get_series(step=3600)
+    assert local["appel"]["series"] == {"0": 3, "2": 1}
+
+def test_local_raw_equal_to_http(monkeypatch):
+    local = local_tweety(monkeypatch, SERIES).get_series(step=3600, raw=True)
+    assert json.loads(local) == json.loads(http_tweety(SERIES).get_series(step=3600, raw=True))
+
+def test_local_resource_error_is_server_error(monkeypatch):
+    tweety = local_tweety(monkeypatch, RuntimeError("connection refused"))
+    with pytest.raises(client.TweetyServerError):
+        tweety.get_series(step=3600)